@@ -9,6 +9,8 @@ TYPE_ID_CONVERSION = {
     'Three': 5,
     'trailerback': 6,
     'VAN':7,
+    'SPECIALCAR': 8,
+    'STACKER': 9,
 }
 TYPE_ID_INVERSE = {
     0:'CAR',
@@ -19,6 +21,8 @@ TYPE_ID_INVERSE = {
     5:'Three',
     6:'trailerback',
     7:'VAN',
+    8:'SPECIALCAR',
+    9:'STACKER',
 }
 
 TYPE_ID_REG_WEIGHT = {
@@ -30,6 +34,8 @@ TYPE_ID_REG_WEIGHT = {
     'Three': 1.0,
     'trailerback': 1.0,
     'VAN':1.0,
+    'SPECIALCAR': 1.0,
+    'STACKER': 1.0,
 }
 
 TYPE_ID_COLOR = {
@@ -43,7 +49,8 @@ TYPE_ID_COLOR = {
     "SPECIALCAR":(122, 0, 122),
     "trailerback":(122, 0, 0),
     "VAN":(255, 122, 0),
-    
+    "STACKER": (114, 114, 114),
+
 }
 
 
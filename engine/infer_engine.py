@@ -0,0 +1,1002 @@
+"""
+In-process inference engine of the test driver.
+
+InferenceEngine builds the detector and loads the checkpoint once, then runs
+any number of input sources through the test pipeline (decode, preprocess,
+model, postprocess, nms / filter, write, render), each with the dataset
+profile of its camera: original image size, crop box, model input size and
+detection threshold. test/test.py is the command line front end of it, a
+sweep over several datasets keeps the model warm in one process:
+
+    engine = InferenceEngine(cfg, model_path)
+    for name, image_dir in [("hh", hh_dir), ("night", night_dir)]:
+        engine.run(iter_image_dir(image_dir), name, os.path.join(output_root, name))
+
+The per-image functions (load_sample, save_result, render_result, ...) take
+the context dict built by InferenceEngine.run.
+"""
+
+import copy
+import json
+import os
+import queue
+import socket
+import time
+
+import cv2
+import numpy as np
+import torch
+import yaml
+from PIL import Image
+from tqdm import tqdm
+
+from config import TYPE_ID_COLOR, TYPE_ID_CONVERSION, TYPE_ID_INVERSE
+from eval.eval_utils.label_parser import box_to_string2
+from model.detector_test import KeypointDetector_v2
+from model.head.detector_infer_test import postprocess
+from model.head.detector_predictor_test import FusedPredictor
+from model.layers.utils import nms_hm, select_point_of_interest, select_topk
+from utils import comm
+from utils.artifact import export_artifact, is_exported_program, load_artifact
+from utils.backends import is_onnx
+from utils.back_project import back_project_results, results_to_host
+from utils.benchmark import Benchmark, print_benchmark
+from utils.bev import new_bev_map, draw_bev_boxes
+from utils.calib_cache import load_calibration, get_calib_cache
+from utils.canvas import get_canvas
+from utils.check_point import DetectronCheckpointer
+from utils.det_columnar import ColumnarWriter
+from utils.filter_rules import load_filter_rules
+from utils.fusion import check_parity, fuse_conv_bn, to_channels_last
+from utils.nms2d import nms_eara
+from utils.pipeline import Stage, StageStats, feed, iter_ordered, print_stage_summary
+from utils.preprocess import get_preprocessor
+from utils.precision import PrecisionParity, autocast, check_precision, print_parity
+from utils.profiling import profile_detector
+from utils.quantization import calibrate, convert_detector, prepare_detector, set_quant_backend
+from utils.render_service import RenderService
+from utils.run_manifest import RunManifest, file_sha1
+from utils.sources import Frame, item_path
+from utils.vis3d import Object3d, draw_projected_box3d
+from utils.visualize_infer import show_result_keypoints, corner_to_3dboundingbox
+
+PROFILE_KEYS = ("image_size", "crop", "input_size", "thres")
+
+# image_size / crop: [w, h] / [x1, y1, x2, y2] in the original image
+# input_size: [w, h] of the model, the crop has the same aspect ratio
+DATASET_PROFILES = {
+    "hh": {"image_size": [3840, 2160], "crop": [0, 240, 3840, 2160], "input_size": [640, 320], "thres": 0.29},
+    "side": {"image_size": [2880, 1860], "crop": [0, 420, 2880, 1860], "input_size": [640, 320], "thres": 0.29},
+    "night": {"image_size": [1936, 1220], "crop": [8, 68, 1928, 1220], "input_size": [640, 384], "thres": 0.29},
+    "port": {"image_size": [1920, 1208], "crop": [0, 56, 1920, 1208], "input_size": [640, 384], "thres": 0.29},
+}
+
+# options of InferenceEngine.run, same names as the flags of test/test.py
+RUN_DEFAULTS = {
+    "calib_path": None,
+    "fallback_calib": None,
+    "alpha": 0.3,
+    "vis_25d": False,
+    "vis_3d": False,
+    "vis_video": False,
+    "vis_canvas": "full",
+    "output_height": 800,
+    "batch_size": 1,
+    "num_loaders": 0,
+    "num_writers": 0,
+    "num_renderers": 1,
+    "render_policy": "block",
+    "render_every": 1,
+    "queue_size": 16,
+    "det_format": "txt",
+    "filter_rules": None,
+    "resume": False,
+    "reduced_decode": False,
+    "pin_memory": False,
+    "calib_dedup": False,
+    "benchmark": False,
+    "benchmark_warmup": 10,
+    "profile": 0,
+    "sparse_heads": False,
+    "parity_tol": 1e-3,
+    "precision": "fp32",
+    "parity_every": 1,
+    "parity_box_tol": 2.0,
+    "parity_depth_tol": 0.01,
+}
+
+
+def load_dataset_profiles(profiles_file=None):
+    """ DATASET_PROFILES, updated with the profiles of a yaml file if given. """
+    profiles = copy.deepcopy(DATASET_PROFILES)
+    if profiles_file is not None:
+        with open(profiles_file, "r") as f:
+            for name, profile in (yaml.safe_load(f) or {}).items():
+                profiles[name] = dict(profiles.get(name, {}), **profile)
+    return profiles
+
+
+def resolve_profile(profile, profiles=DATASET_PROFILES):
+    """
+        profile: name of a dataset profile, or a dict with PROFILE_KEYS
+        return: name (None for a dict), copy of the profile
+    """
+    if isinstance(profile, str):
+        if profile not in profiles:
+            raise ValueError("unknown dataset profile {}, known: {}".format(profile, sorted(profiles)))
+        name, profile = profile, profiles[profile]
+    else:
+        name = None
+    missing = [key for key in PROFILE_KEYS if profile.get(key) is None]
+    if len(missing) > 0:
+        raise ValueError("dataset profile {} misses {}".format(name, missing))
+    return name, {key: copy.copy(profile[key]) for key in PROFILE_KEYS}
+
+
+def draw_2d(image, bbox_2d, thickness=3):
+    cv2.rectangle(image, (int(bbox_2d[0]), int(bbox_2d[1])),
+                  (int(bbox_2d[2]), int(bbox_2d[3])), (0, 255, 0), thickness)
+    return image
+
+## BEV MAP config
+metric_width, metric_height, worldsize = 800, 800, 160 
+def creat_bev_map(out_size=metric_width):
+    # 极坐标网格模板按尺寸缓存，每帧只拷贝
+    return new_bev_map(out_size, worldsize)
+
+# 空白 KITTI 标签行，检测结果的各字段在 save_result 中逐个填写
+EMPTY_LABEL = " ".join(["DontCare"] + ["0"] * 14)
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def load_calib(calib_folder, basename, fallback_calib=None):
+    """
+        calib_folder/basename.xml, or the fallback_calib xml when the image
+        has none (no calib_folder or no such file).
+    """
+    calib_file = os.path.join(calib_folder, basename + ".xml") if calib_folder is not None else None
+    if calib_file is None or not os.path.isfile(calib_file):
+        if fallback_calib is None:
+            raise FileNotFoundError("no calibration {} for {}, give --calib_path or --fallback_calib".format(calib_file, basename))
+        calib_file = fallback_calib
+    return calib_file, load_calibration(calib_file)
+
+def load_sample(line, ctx):
+    """
+        Read one image path of the source (or take a decoded video Frame) and
+        preprocess the image for the model.
+    """
+    frame = line if isinstance(line, Frame) else None
+    if frame is not None:
+        basename = frame.calib_name
+        impath = frame.path
+        name = frame.name
+    else:
+        line =line.strip()
+        # print("IMG:", line)
+        basename = os.path.basename(line).split('.')[0]
+        impath = line
+        name = impath.split('/')[-1]
+    
+    bench = ctx['bench']
+    preprocessor = ctx['preprocessor']
+    with bench.stage('decode'):
+        calib_file, calib = load_calib(ctx['calib_folder'], basename, ctx['fallback_calib'])
+        if frame is not None:
+            # already decoded by the video source
+            img = img_vis = frame.image
+            h, w = img.shape[:2]
+            reduction = 1
+        elif ctx['reduced_decode']:
+            # smaller jpeg decode for the model, save_result decodes the full image if it draws
+            img, (w, h), reduction = preprocessor.decode(impath, reduced=True)
+            img_vis = None
+        else:
+            img = Image.open(impath).convert('RGB')
+            w,h  =img.size
+            # the same array is warped for the model and drawn on for visualization
+            img = img_vis = np.array(img)
+            reduction = 1
+    
+    with bench.stage('preprocess'):
+        img, calib, scale_z = preprocessor(img, calib, reduction=reduction)
+    trans_affine_inv = preprocessor.trans_affine_inv
+    
+    return {
+        'name': name,
+        'impath': impath,
+        'calib_file': calib_file,
+        'calib': calib,
+        'img': img,
+        'img_vis': img_vis,
+        'is_file': frame is None,
+        'size': (w, h),
+        'reduction': reduction,
+        'trans_affine_inv': trans_affine_inv,
+        'scale_z': scale_z,
+    }
+
+def load_vis_image(sample):
+    """ Full resolution RGB image of a sample for visualization. """
+    if sample['img_vis'] is None:
+        return np.array(Image.open(sample['impath']).convert('RGB'))
+    return sample['img_vis']
+
+def save_result(sample, result, ctx):
+    """
+        Map the detections of one image back to the original image, filter
+        and write them.
+        result: per-image output of postprocess, mapped to the original image and copied to host
+        return: list of written files, job of render_result
+    """
+    name = sample['name']
+    scale_z = sample['scale_z']
+    crop_box = ctx['crop_box']
+    trunc_alpha = ctx['trunc_alpha']
+    save_dir_txt = ctx['save_dir_txt']
+    bench = ctx['bench']
+    
+    clses,alphas,rotys, box2d, dimensions,scores,locations,keypoint, keypoint_visible,center_proj, center_type = result
+    
+    if clses is None:
+        # print("no results:",name)
+        return [], {'sample': sample, 'objs': None}
+    
+    ## 已映射回原图(back_project_results)
+    box2d_ori = box2d
+    center_proj = center_proj.astype(int)
+    locations[:,2] = locations[:,2]/scale_z
+
+    ## 筛除重叠BBOX
+    with bench.stage('nms'):
+        dets = np.concatenate((box2d_ori,scores.reshape(-1,1)),axis=1)
+        dets = np.concatenate((dets,clses.reshape(-1,1)),axis=1)
+        keep = nms_eara(dets,0.85) 
+    
+    ## 生成要保留的object
+    with bench.stage('filter'):
+        save_mask, truncation = ctx['filter_rules'](box2d_ori, scores, clses, crop_box, keep, trunc_alpha)
+    save_obj = []
+    for k in np.flatnonzero(save_mask):
+        obj = Object3d(EMPTY_LABEL)
+        obj.t = locations[k]
+        obj.w = dimensions[k][1]
+        obj.l = dimensions[k][2]
+        obj.h = dimensions[k][0]
+        obj.ry = rotys[k][0]
+        obj.box2d = box2d_ori[k]
+        obj.xmin = box2d_ori[k][0]
+        obj.ymin = box2d_ori[k][1]
+        obj.xmax = box2d_ori[k][2]
+        obj.ymax = box2d_ori[k][3]
+        obj.type = TYPE_ID_INVERSE[int(clses[k])]
+        obj.keypoint_down= np.array([[kp[0],kp[1]] if vis else [-1,-1]for kp,vis in zip(keypoint[k],keypoint_visible[k])])
+        obj.alpha = scores[k][0]
+        obj.center_type = center_type[k]
+        obj.truncation = truncation[k]
+        # for visualization
+        obj.index = k
+        obj.keypoint = keypoint[k]
+        obj.keypoint_visible = keypoint_visible[k]
+        obj.center_proj = center_proj[k]
+        save_obj.append(obj) 
+    
+    outputs = []
+    with bench.stage('write'):
+        ## 输出txt
+        if ctx['det_format'] in ('txt', 'both'):
+            txt_path = os.path.join(save_dir_txt,name.replace('jpg','txt').replace('png','txt'))
+            outputs.append(txt_path)
+            with open(txt_path,'w') as f:
+                for i,obj in enumerate(save_obj):
+                    # print(obj.alpha)
+                    cube = np.zeros([8,2])-1
+                    cube[0:4,0:2] = obj.keypoint_down
+                    cube = cube.tolist()
+                    visline =[-1,-1,-1,-1]
+                    v_id = 0
+                    output = box_to_string2(obj.type,[obj.w,obj.l,obj.h],[obj.t[0],obj.t[1],obj.t[2]],obj.box2d,float(obj.truncation+0),0,obj.alpha,obj.ry,cube,visline,v_id)
+                    f.write(output+'\n')
+        ## 输出列存储npz
+        if ctx['columnar'] is not None:
+            save_ids = np.flatnonzero(save_mask)
+            outputs.append(ctx['columnar'].add(name, {
+                'cls': clses.reshape(-1)[save_ids],
+                'truncation': truncation[save_ids],
+                'score': scores.reshape(-1)[save_ids],
+                'box2d': box2d_ori[save_ids],
+                'dimensions': dimensions[save_ids],
+                'location': locations[save_ids],
+                'ry': rotys.reshape(-1)[save_ids],
+                'keypoints': keypoint[save_ids],
+                'keypoint_visible': keypoint_visible[save_ids],
+            }))
+    render_job = {'sample': sample, 'objs': save_obj} if ctx['vis_25d'] or ctx['vis_3d'] else None
+    return outputs, render_job
+
+def render_result(job, ctx):
+    """
+        Draw the objects saved for one image and write the visualizations.
+        return: dict of video stream -> frame
+    """
+    sample, objs = job['sample'], job['objs']
+    name = sample['name']
+    savename = name
+    roi_box = ctx['crop_box']
+    vis_25d, vis_3d = ctx['vis_25d'], ctx['vis_3d']
+    save_dir_25d, save_dir_3d = ctx['save_dir_25d'], ctx['save_dir_3d']
+    
+    img_vis = load_vis_image(sample)
+    output_height = ctx['output_height']
+    output_size = (int(img_vis.shape[1]*output_height/img_vis.shape[0]), output_height)
+    scale_first = ctx['vis_canvas'] == 'scaled'
+    
+    if objs is None:
+        canvas = get_canvas('25D', output_size, scale_first)
+        img_25d = canvas.begin(img_vis, cv2.COLOR_RGB2BGR)
+        draw_2d(img_25d, canvas.box(roi_box), canvas.thickness(3))
+        cv2.imwrite(os.path.join(save_dir_25d,name), canvas.finish())
+        return {}
+    
+    calib = load_calibration(sample['calib_file'])
+    # calib = update_calib(calib)
+    
+    ## 在输出尺寸的画布上绘制(--vis_canvas scaled)，几何坐标、线宽、字号按比例缩放
+    if vis_25d:
+        canvas_25d = get_canvas('25D', output_size, scale_first)
+        img_25d = canvas_25d.begin(img_vis, cv2.COLOR_RGB2BGR)
+        draw_2d(img_25d, canvas_25d.box(roi_box), canvas_25d.thickness(3))
+    if vis_3d:
+        canvas_3d = get_canvas('3D', output_size, scale_first)
+        # BEV as tall as the 3D canvas it is concatenated with
+        img_bev = creat_bev_map(output_height)
+        bev_corners, bev_colors = [], []
+        img_3d = canvas_3d.begin(img_vis, cv2.COLOR_RGB2BGR)
+        draw_2d(img_3d, canvas_3d.box(roi_box), canvas_3d.thickness(3))
+    
+    for obj in objs:
+        k = obj.index
+        if vis_3d:
+            ## 3D box可视化
+            if obj.type in [ "CAR","PD","Rider","Three","BUS","TRUCK","TRUCKHEAD","VAN","SPECIALCAR", "STACKER"]:
+                # corners_3d_det = obj.generate_corners3d()
+                corners_3d_det = corner_to_3dboundingbox(obj.t,[obj.h, obj.w, obj.l], obj.ry,obj.center_type)
+                bev_corners.append(corners_3d_det)
+                bev_colors.append(TYPE_ID_COLOR[obj.type])
+                corners_2d_det, depth = calib.project_rect_to_image(corners_3d_det)
+                img_3d = draw_projected_box3d(img_3d, canvas_3d.points(corners_2d_det), 0, cls=obj.type, color=TYPE_ID_COLOR[obj.type], thickness=canvas_3d.thickness(2), draw_orientation=False,draw_corner=False)
+        if vis_25d:
+            ## 2.5D可视化
+            if obj.type in [ "CAR","PD","Rider","Three","BUS","TRUCK","TRUCKHEAD","VAN","SPECIALCAR", "STACKER"]:
+                box2d = canvas_25d.box(obj.box2d)
+                center_proj = canvas_25d.point(obj.center_proj)
+                if obj.type in [ "CAR","Three","BUS","TRUCK","TRUCKHEAD","VAN","SPECIALCAR", "STACKER"]:
+                    img_25d = show_result_keypoints(img_25d,obj.keypoint_visible,canvas_25d.points(obj.keypoint),box2d,thickness=canvas_25d.thickness(4)) # 绘制keypoints
+                
+                cv2.circle(img_25d, center_proj,canvas_25d.thickness(2),(0,0,255),canvas_25d.thickness(2)) # box中心圆圈
+                cv2.putText(img_25d, '{}{}'.format(k, obj.type), tuple(box2d[0:2].astype(int)), cv2.FONT_HERSHEY_SIMPLEX, 
+                                    canvas_25d.font_scale(1), (255, 100, 0), canvas_25d.thickness(2), cv2.LINE_AA) # box左上角类别
+                cv2.putText(img_25d, '{:.3f}'.format(obj.alpha), center_proj, cv2.FONT_HERSHEY_SIMPLEX, 
+                                    canvas_25d.font_scale(1), (255, 0, 0), canvas_25d.thickness(2), cv2.LINE_AA) # 置信度
+                cv2.rectangle(img_25d, tuple(box2d[0:2].astype(int)), tuple(box2d[2:4].astype(int)), (0, 0, 255), thickness = canvas_25d.thickness(2)) # bbox
+    
+    if vis_3d:
+        img_bev = draw_bev_boxes(img_bev, bev_corners, bev_colors, world_size=worldsize, out_size=output_height)
+    
+    ## the canvas buffers are reused by the next frame, the videos get copies
+    frames = {}
+    if vis_25d:
+        img_25d = canvas_25d.finish()
+        cv2.imwrite(os.path.join(save_dir_25d,savename) ,img_25d)
+        if ctx['vis_video']:
+            frames['25D'] = img_25d.copy()
+    if vis_3d:
+        img_array = np.concatenate((img_bev, canvas_3d.finish()), axis=1)
+        cv2.imwrite(os.path.join(save_dir_3d,savename) ,img_array) ## 3d box
+        frames['3D'] = img_array
+    return frames
+
+def timed_render(job, ctx):
+    """ render_result, a failing image is recorded in ctx['failures'] as well. """
+    try:
+        with ctx['bench'].stage('render'):
+            return render_result(job, ctx)
+    except Exception as e:
+        ctx['failures'].append((job['sample']['impath'], 'render', repr(e)))
+        raise
+
+def try_load_sample(line, ctx):
+    """ load_sample, a failing image is recorded in ctx['failures'] and skipped. """
+    try:
+        return load_sample(line, ctx)
+    except Exception as e:
+        ctx['failures'].append((item_path(line), 'load', repr(e)))
+        return None
+
+def finish_sample(sample, result, ctx):
+    """
+        save_result, then mark the image as done in the run manifest, once its
+        columnar part is written if it has one.
+    """
+    render_job = None
+    try:
+        outputs, render_job = save_result(sample, result, ctx)
+    except Exception as e:
+        ctx['failures'].append((sample['impath'], 'save', repr(e)))
+        return
+    finally:
+        # every frame index goes to the render service, to keep the videos going
+        sample.pop('img', None)
+        if render_job is not None:
+            ctx['render'].submit(sample['index'], render_job)
+        else:
+            ctx['render'].skip(sample['index'])
+    if not sample['is_file']:
+        # video frames can not be resumed
+        return
+    record = lambda: ctx['manifest'].record(sample['impath'], outputs)
+    if ctx['columnar'] is not None and len(outputs) > 0 and outputs[-1].endswith('.npz'):
+        ctx['columnar'].on_flushed(outputs[-1], record)
+    else:
+        record()
+
+def run_profile(model, postproc, lines, ctx, opts, output_dir, device, proc_id=0, num_skipped=0):
+    """
+        --profile N: N iterations of the model and postprocess on the first
+        batch of images under torch.profiler, nothing else is run.
+    """
+    start_time = time.time()
+    samples = []
+    for line in lines:
+        sample = try_load_sample(line, ctx)
+        if sample is not None:
+            samples.append(sample)
+        if len(samples) == opts['batch_size']:
+            break
+    if len(samples) > 0:
+        imgs = torch.stack([sample['img'] for sample in samples]).to(device, memory_format=ctx['memory_format'])
+        trace_path, table_path, table = profile_detector(model, postproc, imgs, [sample['calib'] for sample in samples],
+                                                         opts['profile'], output_dir, rank=proc_id)
+        print(table)
+        print("profiler trace saved to", trace_path)
+        print("operator summary saved to", table_path)
+    else:
+        print("no image to profile")
+    return {
+        'rank': proc_id,
+        'host': socket.gethostname(),
+        'images': 0,
+        'skipped': num_skipped,
+        'failures': ctx['failures'],
+        'wall_time': time.time() - start_time,
+        'infer_time': 0.0,
+    }
+
+
+def release_videos(videos):
+    for video in videos.values():
+        if video is not None:
+            video.release()
+
+
+class InferenceEngine(object):
+    def __init__(self, cfg, model_path, device=None, config_file=None, profiles=None):
+        """
+            cfg: model config, the checkpoint is loaded into KeypointDetector_v2(cfg)
+            device: torch device, default cfg.MODEL.DEVICE
+            config_file: yaml cfg comes from, its sha1 goes to the run manifests
+            profiles: dataset profiles run() looks names up in, default DATASET_PROFILES
+        """
+        device = torch.device(device if device is not None else cfg.MODEL.DEVICE)
+        config_sha1 = file_sha1(config_file) if config_file is not None and os.path.isfile(config_file) else None
+
+        ## Load model
+        model = KeypointDetector_v2(cfg).to(device)
+        checkpointer = DetectronCheckpointer(cfg, model, save_dir=cfg.OUTPUT_DIR)
+        _ = checkpointer.load(model_path, use_latest=False)
+        model.eval()
+        self._setup(model, device, model_path, file_sha1(model_path), config_sha1, profiles)
+        self.cfg = cfg
+
+    @classmethod
+    def from_artifact(cls, artifact_path, device=None, profiles=None):
+        """ Engine of an artifact of export(), see utils/artifact.py. """
+        if is_onnx(artifact_path):
+            # ONNX Runtime on the cpu, with the intra-op threads of torch (--num_threads)
+            if device is not None and torch.device(device).type != 'cpu':
+                raise ValueError("onnx artifact {} runs on the cpu only, not {}".format(artifact_path, device))
+            device = 'cpu'
+        device = torch.device(device if device is not None else ('cuda' if torch.cuda.is_available() else 'cpu'))
+        model, meta = load_artifact(artifact_path, device, torch.get_num_threads())
+        if meta.get('quant_backend') is not None:
+            # INT8 kernels of the backend the model was calibrated for, CPU only
+            if device.type != 'cpu':
+                raise ValueError("quantized artifact {} runs on the cpu only, not {}".format(artifact_path, device))
+            set_quant_backend(meta['quant_backend'])
+        engine = cls.__new__(cls)
+        engine._setup(model, device, artifact_path, meta.get('checkpoint'), meta.get('config'), profiles, meta)
+        # the graph of an exported program / onnx model can not be called per submodule
+        engine.split_stages = not is_exported_program(artifact_path) and not is_onnx(artifact_path)
+        return engine
+
+    def _setup(self, model, device, model_path, checkpoint_sha1, config_sha1, profiles, meta=None):
+        self.cfg = None
+        self.model = model
+        self.device = device
+        self.model_path = model_path
+        self.checkpoint_sha1 = checkpoint_sha1
+        self.config_sha1 = config_sha1
+        self.profiles = profiles if profiles is not None else DATASET_PROFILES
+        self.meta = meta
+        self.split_stages = True
+        self.fused_bn = meta.get('fused_bn', 0) if meta is not None else 0
+        self.channels_last = meta.get('channels_last', False) if meta is not None else False
+        self.fused_heads = meta.get('fused_heads', False) if meta is not None else False
+        self.quant_backend = meta.get('quant_backend') if meta is not None else None
+        self._postprocs = {}
+
+    def get_postprocess(self, input_size, thres):
+        """ postprocess of an input size and threshold, built once. """
+        key = (tuple(input_size), thres)
+        if key not in self._postprocs:
+            priors = {} if self.meta is None else {'dim_mean': self.meta['dim_mean'], 'dim_std': self.meta['dim_std']}
+            self._postprocs[key] = postprocess(input_size[0], input_size[1], thres, **priors).to(self.device)
+        return self._postprocs[key]
+
+    def optimize(self, input_size, fuse_bn=True, channels_last=False, fuse_heads=False, atol=1e-3, rtol=1e-3):
+        """
+            Fold the BatchNorms into the convolutions, fuse the regression heads
+            (see FusedPredictor) and / or go channels last (see utils/fusion.py),
+            then check on a random input of input_size that the outputs still
+            match the original model.
+            return: max abs difference of every output
+        """
+        if self.cfg is None:
+            raise ValueError("an artifact can not be optimized, export it from an optimized engine instead")
+        reference = copy.deepcopy(self.model)
+        if fuse_bn:
+            self.fused_bn += fuse_conv_bn(self.model)
+        if fuse_heads:
+            self.model.heads = FusedPredictor.from_predictor(self.model.heads)
+            self.fused_heads = True
+        if channels_last:
+            to_channels_last(self.model)
+            self.channels_last = True
+        generator = torch.Generator().manual_seed(0)
+        inputs = torch.randn((1, 3, input_size[1], input_size[0]), generator=generator).to(self.device)
+        matched, max_diffs = check_parity(reference, self.model, inputs, atol, rtol, self.channels_last)
+        del reference
+        if not matched:
+            raise RuntimeError("optimized model differs from the original one, max abs differences {}".format(max_diffs))
+        return max_diffs
+
+    def check_sparse(self, imgs, postproc, calibs, atol=1e-3, rtol=1e-3):
+        """
+            Run the heads of a batch densely and with forward_sparse (see
+            --sparse_heads), in fp32. The regressions gathered at the top-K
+            peaks must match within atol + rtol * |dense|, and postprocess must
+            keep the same detections (classes, scores and peaks of every image).
+            return: dict with matched, max_reg_diff, same_detections, detections
+        """
+        heads = self.model.heads
+        with torch.no_grad():
+            features = self.model.backbone(imgs)
+            output_cls, output_regs = heads(features)
+            output_cls, output_regs = output_cls.contiguous(), output_regs.contiguous()
+            sparse_cls, sparse_regs = heads.forward_sparse(features)
+            sparse_cls = sparse_cls.contiguous()
+            # the peaks postprocess gathers the regressions at
+            _, indexs, _, _, _ = select_topk(nms_hm(output_cls, kernel=5), K=postproc.max_detection)
+            dense_pois = select_point_of_interest(len(imgs), indexs, output_regs)
+            sparse_pois = sparse_regs.select(len(imgs), indexs)
+            dense_results = postproc(output_cls, output_regs, calibs)
+            sparse_results = postproc(sparse_cls, sparse_regs, calibs)
+        max_reg_diff = float((sparse_pois - dense_pois).abs().max())
+        same_detections = True
+        for dense, sparse in zip(dense_results, sparse_results):
+            if dense[0] is None or sparse[0] is None:
+                same_detections = same_detections and dense[0] is None and sparse[0] is None
+                continue
+            # class, score and peak of every kept detection, indexes in the outputs of postprocess
+            same_detections = same_detections and all(torch.equal(dense[i], sparse[i]) for i in (0, 5, 9))
+        return {
+            'matched': same_detections and torch.allclose(sparse_pois, dense_pois, rtol=rtol, atol=atol),
+            'max_reg_diff': max_reg_diff,
+            'same_detections': same_detections,
+            'detections': sum(0 if dense[0] is None else len(dense[0]) for dense in dense_results),
+        }
+
+    def load_batches(self, lines, profile, calib_path=None, batch_size=8, fallback_calib=None):
+        """
+            Decode and preprocess image paths / Frames with a dataset profile
+            like run(), as float batches for the observers of quantize or for
+            compare_backends.
+            return: list of (n, 3, h, w) tensors
+        """
+        _, profile = resolve_profile(profile, self.profiles)
+        input_size = tuple(profile['input_size'])
+        pixel_mean = torch.from_numpy(np.array([0.485, 0.456, 0.406]))
+        pixel_std = torch.from_numpy(np.array([0.229, 0.224, 0.225]))
+        ctx = {
+            'calib_folder': calib_path,
+            'fallback_calib': fallback_calib,
+            'reduced_decode': False,
+            'failures': [],
+            'bench': Benchmark(False),
+            'preprocessor': get_preprocessor(tuple(profile['image_size']), profile['crop'], input_size, pixel_mean, pixel_std),
+        }
+        samples = (try_load_sample(line, ctx) for line in lines)
+        batches = [torch.stack([sample['img'] for sample in samples_batch]).float()
+                   for samples_batch in iter_batches((sample for sample in samples if sample is not None), batch_size)]
+        for path, _, error in ctx['failures']:
+            print("calibration image {} skipped: {}".format(path, error))
+        return batches
+
+    def quantize(self, batches, backend="x86"):
+        """
+            Post-training static INT8 quantization of the backbone and heads,
+            see utils/quantization.py. The model moves to the cpu.
+            batches: calibration batches, see load_batches
+            return: number of calibration images
+        """
+        if self.cfg is None:
+            raise ValueError("an artifact can not be quantized, export it from a float engine instead")
+        if self.fused_bn:
+            # prepare_fx folds the BatchNorms itself, the nn.Identity left by fuse_conv_bn breaks its Conv -> ReLU fusion
+            raise ValueError("quantize the model without fuse_bn, the BatchNorms are folded by the quantization")
+        if len(batches) == 0:
+            raise ValueError("no calibration images")
+        self.device = torch.device('cpu')
+        self._postprocs = {}
+        memory_format = torch.channels_last if self.channels_last else torch.contiguous_format
+        batches = [images.contiguous(memory_format=memory_format) for images in batches]
+        self.model = prepare_detector(self.model.cpu(), batches[0][:1], backend)
+        num_images = calibrate(self.model, batches)
+        self.model = convert_detector(self.model)
+        self.quant_backend = backend
+        return num_images
+
+    def export(self, path, profile, profile_name=None):
+        """
+            Save the model with the metadata of a dataset profile as an
+            artifact, loaded by from_artifact.
+            return: saved metadata
+        """
+        postproc = self.get_postprocess(profile['input_size'], profile['thres'])
+        meta = {key: profile[key] for key in PROFILE_KEYS}
+        meta.update({
+            'dataset': profile_name,
+            'classes': [TYPE_ID_INVERSE[i] for i in range(len(TYPE_ID_INVERSE))],
+            'pixel_mean': [0.485, 0.456, 0.406],
+            'pixel_std': [0.229, 0.224, 0.225],
+            'dim_mean': postproc.dim_mean.tolist(),
+            'dim_std': postproc.dim_std.tolist(),
+            'checkpoint': self.checkpoint_sha1,
+            'config': self.config_sha1,
+            'fused_bn': self.fused_bn,
+            'channels_last': self.channels_last,
+            'fused_heads': self.fused_heads,
+            'quant_backend': self.quant_backend,
+        })
+        if self.quant_backend is not None and (is_exported_program(path) or is_onnx(path)):
+            raise ValueError("a quantized model is exported with TorchScript only, not as {}".format(path))
+        return export_artifact(self.model, path, meta)
+
+    def run(self, source, profile, output_dir, source_desc=None, proc_id=0, num_procs=1, **options):
+        """
+            Test every item of source with a dataset profile.
+            source: list or iterable of image paths / Frames, see utils/sources.py,
+                    already the shard of proc_id if num_procs > 1
+            profile: name of a dataset profile, or a dict with PROFILE_KEYS,
+                     None for the profile of the artifact
+            options: see RUN_DEFAULTS
+            return: summary dict of this run
+        """
+        unknown = set(options) - set(RUN_DEFAULTS)
+        if len(unknown) > 0:
+            raise TypeError("unknown run options {}".format(sorted(unknown)))
+        opts = dict(RUN_DEFAULTS, **options)
+        artifact_profile = profile is None and self.meta is not None
+        if artifact_profile:
+            profile = self.meta
+        profile_name, profile = resolve_profile(profile, self.profiles)
+        if artifact_profile:
+            profile_name = self.meta.get('dataset')
+
+        ###################CONFIGS########################
+        calib_folder = opts['calib_path'] # xml路径
+        input_width, input_height = profile['input_size'] # 模型输入尺寸
+        crop_box = profile['crop'] # cropbox 对角线顶点 [x1, y1, x2, y2]
+        img_width, img_height = profile['image_size'] # 图片原始尺寸
+        det_thres = profile['thres']
+        vis_25d, vis_3d, vis_video = opts['vis_25d'], opts['vis_3d'], opts['vis_video']
+        output_height = opts['output_height']
+        batch_size = opts['batch_size']
+        ################################################
+        device = self.device
+        model = self.model
+        calib_cache = get_calib_cache()
+        calib_cache.dedup_content = opts['calib_dedup']
+        postproc = self.get_postprocess((input_width, input_height), det_thres)
+        precision = opts['precision']
+        check_precision(precision, device)
+        if precision != 'fp32' and (self.quant_backend is not None or not isinstance(model, torch.nn.Module)):
+            raise ValueError("precision {} needs a float torch model, not a quantized or onnx one".format(precision))
+
+        save_dir_3d= os.path.join(output_dir,'3D')
+        save_dir_25d= os.path.join(output_dir,'25D')
+        save_dir_txt= os.path.join(output_dir,'det_txt')
+        os.makedirs(save_dir_3d,exist_ok =True)
+        os.makedirs(save_dir_25d,exist_ok =True)
+        os.makedirs(save_dir_txt, exist_ok =True)
+
+        ## Generate video
+        videos = {'25D': None, '3D': None}
+        if vis_video:
+            fourcc = cv2.VideoWriter_fourcc(*'MJPG')
+            if vis_3d:
+                out3D_size = (int(img_width*output_height/img_height) + output_height,output_height)
+                videos['3D'] = cv2.VideoWriter(os.path.join(output_dir,'3D.avi'), fourcc, 10.0, out3D_size)
+            if vis_25d:
+                out25D_size = (int(img_width*output_height/img_height), output_height)
+                videos['25D'] = cv2.VideoWriter(os.path.join(output_dir,'25D.avi'), fourcc, 10.0, out25D_size)
+
+        lines = source
+        num_lines = len(lines) if isinstance(lines, list) else None
+        if num_procs > 1:
+            print("[RANK {}/{}] {} images on {}, cores {}".format(proc_id, num_procs, num_lines if num_lines is not None else "streamed", socket.gethostname(), sorted(os.sched_getaffinity(0))))
+
+        ## Run manifest, images finished with the same model and parameters are skipped with resume
+        run_config = {
+            'checkpoint': self.checkpoint_sha1,
+            'config': self.config_sha1,
+            'image_size': list(profile['image_size']),
+            'crop': list(crop_box),
+            'input_size': list(profile['input_size']),
+            'reduced_decode': opts['reduced_decode'],
+            'calib_path': calib_folder,
+            'fallback_calib': opts['fallback_calib'],
+            'thres': det_thres,
+            'alpha': opts['alpha'],
+            'vis_25d': vis_25d,
+            'vis_3d': vis_3d,
+            'det_format': opts['det_format'],
+            'precision': opts['precision'],
+        }
+        manifest = RunManifest(output_dir, run_config, rank=proc_id)
+        if opts['resume']:
+            if opts['benchmark']:
+                # every image has to go through the benchmark
+                print("benchmark is on, resume is ignored")
+            elif vis_video:
+                # the video has to contain every frame
+                print("vis_video is on, resume is ignored")
+            else:
+                manifest.load()
+                lines = manifest.skip_current(lines, item_path)
+                if num_lines is not None:
+                    lines = list(lines)
+                    num_lines = len(lines)
+        manifest.open()
+
+        print()
+        print("[TEST INFO]")
+        print(" {:<12}:".format("output_dir"), output_dir)
+        print(" {:<12}:".format("source"), source_desc if source_desc is not None else type(source).__name__)
+        print(" {:<12}:".format("image_num"), num_lines if num_lines is not None else "streamed")
+        if opts['resume'] and num_lines is not None:
+            print(" {:<12}:".format("skipped"), manifest.skipped)
+        print(" {:<12}:".format("model"), self.model_path)
+        print(" {:<12}:".format("dataset"), profile_name if profile_name is not None else "custom")
+        print(" {:<12}:".format("input_size"), list(profile['input_size']))
+        print(" {:<12}:".format("image_size"), list(profile['image_size']))
+        print(" {:<12}:".format("crop_box"), crop_box)
+        print(" {:<12}:".format("thres"), det_thres)
+        print(" {:<12}:".format("vis_25d"), vis_25d)
+        print(" {:<12}:".format("vis_3d"), vis_3d)
+        print(" {:<12}:".format("vis_video"), vis_video)
+        print(" {:<12}:".format("vis_canvas"), opts['vis_canvas'])
+        print(" {:<12}:".format("sparse_heads"), opts['sparse_heads'])
+        print(" {:<12}:".format("precision"), opts['precision'])
+        print(" {:<12}:".format("batch_size"), batch_size)
+        print(" {:<12}:".format("loaders"), opts['num_loaders'])
+        print(" {:<12}:".format("writers"), opts['num_writers'])
+        print(" {:<12}:".format("device"), device)
+        print(" {:<12}:".format("threads"), torch.get_num_threads())
+        print()
+
+        ## Test phrase
+        bench = Benchmark(opts['benchmark'], device, warmup=opts['benchmark_warmup'])
+        pixel_mean = torch.from_numpy(np.array([0.485, 0.456, 0.406]))
+        pixel_std = torch.from_numpy(np.array([0.229, 0.224, 0.225]))
+        test_ctx = {
+            'calib_folder': calib_folder,
+            'fallback_calib': opts['fallback_calib'],
+            'pixel_mean': pixel_mean,
+            'pixel_std': pixel_std,
+            'input_size': (input_width, input_height),
+            'image_size': (img_width, img_height),
+            'crop_box': crop_box,
+            'manifest': manifest,
+            'det_format': opts['det_format'],
+            'columnar': ColumnarWriter(os.path.join(output_dir, 'det_npz'), [TYPE_ID_INVERSE[i] for i in range(len(TYPE_ID_INVERSE))], rank=proc_id) if opts['det_format'] in ('npz', 'both') else None,
+            'filter_rules': load_filter_rules(opts['filter_rules'], TYPE_ID_CONVERSION),
+            'failures': [],
+            'reduced_decode': opts['reduced_decode'],
+            'preprocessor': get_preprocessor((img_width, img_height), crop_box, (input_width, input_height), pixel_mean, pixel_std),
+            'trunc_alpha': opts['alpha'],
+            'bench': bench,
+            'vis_25d': vis_25d,
+            'vis_3d': vis_3d,
+            'vis_video': vis_video,
+            'vis_canvas': opts['vis_canvas'],
+            'output_height': output_height,
+            'save_dir_25d': save_dir_25d,
+            'save_dir_3d': save_dir_3d,
+            'save_dir_txt': save_dir_txt,
+            'memory_format': torch.channels_last if self.channels_last else torch.contiguous_format,
+        }
+        if opts['reduced_decode']:
+            print("reduced decode: jpeg images at 1/{} size".format(test_ctx['preprocessor'].max_reduction))
+        if opts['profile'] > 0:
+            # postprocess casts back to fp32 itself
+            with autocast(precision, device):
+                summary = run_profile(model, postproc, lines, test_ctx, opts, output_dir, device, proc_id, manifest.skipped)
+            manifest.close()
+            release_videos(videos)
+            return summary
+        num_loaders, num_writers = opts['num_loaders'], opts['num_writers']
+        sparse_heads = opts['sparse_heads']
+        if sparse_heads and not hasattr(getattr(model, 'heads', None), 'forward_sparse'):
+            raise ValueError("sparse_heads needs the model of a checkpoint, the graph of an artifact has no forward_sparse")
+
+        def infer(imgs, samples, precision, bench):
+            """ model, postprocess and back projection of a batch. return: host results """
+            num = len(samples)
+            with autocast(precision, device):
+                if sparse_heads:
+                    # dense heatmap, the regression heads run in postprocess at its peaks
+                    with bench.stage('backbone', num, sync=True):
+                        features = model.backbone(imgs)
+                    with bench.stage('heads', num, sync=True):
+                        output_cls,  output_regs = model.heads.forward_sparse(features)
+                elif bench.enabled and self.split_stages:
+                    # backbone and heads timed apart
+                    with bench.stage('backbone', num, sync=True):
+                        features = model.backbone(imgs)
+                    with bench.stage('heads', num, sync=True):
+                        output_cls,  output_regs = model.heads(features)
+                else:
+                    output_cls,  output_regs =  model(imgs)
+            # postprocess views the outputs as NCHW, a no-op unless channels last
+            output_cls = output_cls.contiguous()
+            if not sparse_heads:
+                output_regs = output_regs.contiguous()
+            # one Calibration per image, every image is decoded in one pass
+            # (under autocast for the sparse heads, their convs run at the peaks)
+            with bench.stage('postprocess', num, sync=True), autocast(precision if sparse_heads else 'fp32', device):
+                results = postproc(output_cls, output_regs, [sample['calib'] for sample in samples])
+            # boxes, keypoints and centers of the whole batch to the original images, then one copy to host
+            with bench.stage('to_host', num, sync=True):
+                results = back_project_results(results, [sample['trans_affine_inv'] for sample in samples], [sample['size'] for sample in samples])
+                return results_to_host(results)
+
+        ## detections changed by the reduced precision, on one batch out of parity_every
+        parity = PrecisionParity(opts['parity_box_tol'], opts['parity_depth_tol']) if precision != 'fp32' and opts['parity_every'] > 0 else None
+        untimed = Benchmark(False)
+        ## visualization off the hot path, in frame order for the videos
+        test_ctx['render'] = RenderService(lambda job: timed_render(job, test_ctx), opts['num_renderers'], opts['queue_size'],
+                                           opts['render_policy'], opts['render_every'], videos=videos)
+        with torch.no_grad():
+            pbar = tqdm(total=num_lines, unit='img', position=comm.get_local_rank())
+            start_time = time.time()
+            infer_stats = StageStats('infer')
+
+            ## decode + preprocess workers ahead of the model
+            if num_loaders > 0:
+                loaded = queue.Queue(maxsize=opts['queue_size'])
+                loader = Stage('decode', lambda line: try_load_sample(line, test_ctx), num_loaders, opts['queue_size'], output=loaded).start()
+                feed(loader, lines)
+                samples_iter = iter_ordered(loaded, num_lines)
+            else:
+                loaded = None
+                samples_iter = (try_load_sample(line, test_ctx) for line in lines)
+            ## writer / visualizer workers behind the model
+            writer = Stage('write', lambda job: finish_sample(*job), num_writers, opts['queue_size']).start() if num_writers > 0 else None
+
+            ## reused input batch, pinned so that the copy to the device can be async
+            pin_memory = opts['pin_memory'] and device.type == 'cuda'
+            batch_buffer = torch.empty((batch_size, 3, input_height, input_width), dtype=torch.float32, pin_memory=pin_memory)
+
+            num_done = 0
+            num_batches = 0
+            sparse_parity = None
+            for samples in iter_batches((sample for sample in samples_iter if sample is not None), batch_size):
+                if loaded is not None:
+                    infer_stats.sample_depth(loaded.qsize())
+                infer_start = time.time()
+                num = len(samples)
+                with bench.stage('h2d', num, sync=True):
+                    imgs = torch.stack([sample['img'] for sample in samples], out=batch_buffer[:num])
+                    imgs = imgs.to(device, non_blocking=pin_memory, memory_format=test_ctx['memory_format'])
+
+                results = infer(imgs, samples, precision, bench)
+                infer_stats.add_busy(time.time() - infer_start, num)
+                if sparse_heads and num_batches == 0:
+                    # the dense heads on the first batch, before anything is written, not timed
+                    sparse_parity = self.check_sparse(imgs, postproc, [sample['calib'] for sample in samples], opts['parity_tol'], opts['parity_tol'])
+                    print(" {:<12}: {} detections of the first batch {}, max abs regression difference {:.2e}".format(
+                        "sparse_heads", sparse_parity['detections'], "kept" if sparse_parity['same_detections'] else "CHANGED", sparse_parity['max_reg_diff']))
+                    if not sparse_parity['matched']:
+                        raise RuntimeError("sparse heads differ from the dense ones: {}".format(sparse_parity))
+                if parity is not None and num_batches % opts['parity_every'] == 0:
+                    # the same batch in fp32, not timed
+                    parity.add(infer(imgs, samples, 'fp32', untimed), results)
+
+                for sample, result in zip(samples, results):
+                    sample['index'] = num_done
+                    if writer is not None:
+                        writer.put(num_done, (sample, result, test_ctx))
+                    else:
+                        finish_sample(sample, result, test_ctx)
+                    num_done += 1
+                num_batches += 1
+                bench.count_images(num, warm=num_batches > opts['benchmark_warmup'])
+                pbar.update(len(samples))
+            if writer is not None:
+                writer.close()
+                if writer.errors:
+                    raise writer.errors[0][1]
+            render = test_ctx['render']
+            render.close()
+            # the end to end window includes draining the writers and renderers
+            bench.count_images(0, warm=num_batches > opts['benchmark_warmup'])
+            pbar.close()
+
+            if num_loaders > 0 or num_writers > 0:
+                stage_stats = [loader.stats] if num_loaders > 0 else []
+                stage_stats.append(infer_stats)
+                if writer is not None:
+                    stage_stats.append(writer.stats)
+                stage_stats.append(render.stats)
+                print_stage_summary(stage_stats, time.time() - start_time)
+            print(" {:<12}: {} rendered, {} dropped, {} sampled out, {} failed".format("render", render.rendered, render.dropped, render.sampled_out, len(render.errors)))
+            print(" {:<12}: {} hits, {} parsed".format("calib_cache", calib_cache.hits, calib_cache.misses))
+            if parity is not None:
+                print_parity(parity.summary(), precision)
+        if test_ctx['columnar'] is not None:
+            test_ctx['columnar'].close()
+        manifest.close()
+        if bench.enabled:
+            bench_path = os.path.join(output_dir, 'benchmark.json' if num_procs == 1 else 'benchmark.{}.json'.format(proc_id))
+            print_benchmark(bench.save(bench_path, meta=dict(run_config, batch_size=batch_size, device=str(device),
+                                                              num_loaders=num_loaders, num_writers=num_writers,
+                                                              num_renderers=opts['num_renderers'], fused_bn=self.fused_bn,
+                                                              channels_last=self.channels_last, fused_heads=self.fused_heads,
+                                                              quant_backend=self.quant_backend, sparse_heads=sparse_heads)))
+            print("benchmark saved to", bench_path)
+        if parity is not None:
+            parity_path = os.path.join(output_dir, 'precision_parity.json' if num_procs == 1 else 'precision_parity.{}.json'.format(proc_id))
+            with open(parity_path, 'w') as f:
+                json.dump(dict(parity.summary(), precision=precision, dataset=profile_name, parity_every=opts['parity_every']), f, indent=2)
+        release_videos(videos)
+
+        return {
+            'rank': proc_id,
+            'host': socket.gethostname(),
+            'images': num_done,
+            'skipped': manifest.skipped,
+            'failures': test_ctx['failures'],
+            'wall_time': time.time() - start_time,
+            'infer_time': infer_stats.busy_time,
+            'precision_parity': parity.summary() if parity is not None else None,
+            'sparse_parity': sparse_parity,
+        }
@@ -25,7 +25,8 @@ def launch(main_func,
            num_machines=1,
            machine_rank=0,
            dist_url=None,
-           args=()):
+           args=(),
+           backend="NCCL"):
     """
     Args:
         main_func: a function that will be called by `main_func(*args)`
@@ -35,6 +36,7 @@ def launch(main_func,
                        e.g. "tcp://127.0.0.1:8686".
                        Can be set to auto to automatically select a free port on localhost
         args (tuple): arguments passed to main_func
+        backend (str): "NCCL" with one gpu per process, or "gloo" for cpu processes
     """
 
     world_size = num_machines * num_gpus_per_machine
@@ -50,7 +52,7 @@ def launch(main_func,
         mp.spawn(
             _distributed_worker,
             nprocs=num_gpus_per_machine,
-            args=(main_func, world_size, num_gpus_per_machine, machine_rank, dist_url, args),
+            args=(main_func, world_size, num_gpus_per_machine, machine_rank, dist_url, args, backend),
             daemon=False,
         )
     else:
@@ -58,13 +60,15 @@ def launch(main_func,
 
 
 def _distributed_worker(
-        local_rank, main_func, world_size, num_gpus_per_machine, machine_rank, dist_url, args
+        local_rank, main_func, world_size, num_gpus_per_machine, machine_rank, dist_url, args, backend="NCCL"
 ):
-    assert torch.cuda.is_available(), "cuda is not available. Please check your installation."
+    use_cuda = backend.lower() == "nccl"
+    if use_cuda:
+        assert torch.cuda.is_available(), "cuda is not available. Please check your installation."
     global_rank = machine_rank * num_gpus_per_machine + local_rank
     try:
         dist.init_process_group(
-            backend="NCCL", init_method=dist_url, world_size=world_size, rank=global_rank
+            backend=backend, init_method=dist_url, world_size=world_size, rank=global_rank
         )
     except Exception as e:
         logger = logging.getLogger(__name__)
@@ -74,8 +78,9 @@ def _distributed_worker(
     # See: https://github.com/facebookresearch/maskrcnn-benchmark/issues/172
     comm.synchronize()
 
-    assert num_gpus_per_machine <= torch.cuda.device_count()
-    torch.cuda.set_device(local_rank)
+    if use_cuda:
+        assert num_gpus_per_machine <= torch.cuda.device_count()
+        torch.cuda.set_device(local_rank)
 
     # Setup the local process group (which contains ranks within the same machine)
     assert comm._LOCAL_PROCESS_GROUP is None
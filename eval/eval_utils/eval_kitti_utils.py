@@ -1208,13 +1208,13 @@ def draw_dotted_line(img, pt1, pt2, color, thickness=1, style='dotted', gap=4):
                 cv2.line(img,s,e,color,thickness)
             i+=1
 
-def draw_boxcube(image,obj, thickness=4):
-    
+def draw_boxcube(image,obj, thickness=4, radius=3, scale=(1, 1)):
+    # scale: x, y scale of the image to the original one
     if obj.type != "PD" and obj.type != "Rider":
-        obj_x = obj.orientation_x[obj.mask]
-        obj_y = obj.orientation_y[obj.mask]
+        obj_x = obj.orientation_x[obj.mask] * scale[0]
+        obj_y = obj.orientation_y[obj.mask] * scale[1]
         for i, (x, y) in enumerate(zip(obj_x, obj_y)):
-            cv2.circle(image, (int(x), int(y)), 3, (0, 255, 0), thickness)
+            cv2.circle(image, (int(x), int(y)), radius, (0, 255, 0), thickness)
     return image
 
 
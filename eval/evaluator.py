@@ -9,10 +9,14 @@ import json
 import utils.kitti_common as kitti
 from utils.visualize_infer import show_result_keypoints
 from eval.eval_utils.eval_kitti_utils import draw_boxcube, calculate_cube_error_onlyrear, draw_projected_box3d, \
-    draw_bev_box3d, Calibration, read_label,\
+    Calibration, read_label, Object3d,\
     calculate_depth_error, sum_list, mean_list, seperate_POS_NEG
 from eval.eval_utils.eval_vis_two_box import vis_two_box
 from eval.eval_utils.label_parser import LabelParser
+from utils.calib_cache import load_calibration
+from utils.det_columnar import find_det_parts, load_det_columnar
+from utils.canvas import get_canvas, VIS_CANVAS_MODES
+from utils.bev import new_bev_map, draw_bev_boxes
 from eval.eval_utils.parse_results import parse_metrics, toxlxs_3d, toxlxs_cube, merge_video
 from tqdm import tqdm
 import argparse
@@ -28,14 +32,14 @@ colors = {"VAN" : (0, 0, 255),
           "trailback":(122,122,122),
           "trailerback":(122,122,122)} #
 
-def draw_2d(image, bbox_2d):
+def draw_2d(image, bbox_2d, thickness=10):
     ## 绘制2d box
     cv2.rectangle(image, (int(bbox_2d[0]), int(bbox_2d[1])),
-                  (int(bbox_2d[2]), int(bbox_2d[3])), (0, 255, 0), 10)
+                  (int(bbox_2d[2]), int(bbox_2d[3])), (0, 255, 0), thickness)
     return image
 
-def draw_point(image, center):
-    cv2.circle(image, (int(center[0]), int(center[1])), 10,(0, 0, 255), 2)
+def draw_point(image, center, radius=10, thickness=2):
+    cv2.circle(image, (int(center[0]), int(center[1])), radius,(0, 0, 255), thickness)
     return image
 
 def align_center_corners3d(whl,ry=0):
@@ -73,6 +77,8 @@ class Evaluator:
         self.gt_path = gt_path
         self.det_path = det_path
         self.calib_path = calib_path
+        # det_path may also be the det_npz dir (or one npz part) of the test script
+        self.det_columnar = load_det_columnar(det_path) if len(find_det_parts(det_path)) > 0 else None
         _, _, self.imgpaths, self.labels, self.labels_det = self._init_label_det_object()
         self.cropper = LabelParser(img_shape, crop_coor)
         
@@ -108,6 +114,16 @@ class Evaluator:
         
         for i, (label_filename_det, label_filename_gt) in enumerate(zip(dt_files, label_files)):
             # print(label_filename_det, label_filename_gt)
+            if self.det_columnar is not None:
+                lines_det = self.det_columnar.kitti_lines(os.path.basename(image_files[i]))
+                if lines_det is not None and os.path.exists(label_filename_gt):
+                    labels.append(read_label(label_filename_gt))
+                    labels_det.append([Object3d(line) for line in lines_det])
+                    annos_gt.append(kitti.get_label_anno(label_filename_gt))
+                    annos_det.append(kitti.get_label_anno_from_lines(lines_det))
+                    continue
+                # no detection output of this image, as a missing txt
+                label_filename_det = ""
             if os.path.exists(label_filename_det) and os.path.exists(label_filename_gt):
                 # print(label_filename_gt)
                 label = read_label(label_filename_gt)
@@ -131,7 +147,7 @@ class Evaluator:
         return annos_gt,annos_det,image_files,labels,labels_det
     
     def evaluate(self, eval2D, eval25D, eval3D, vizGT=True, video=True, \
-        box_size_range=[32, 96], channel=1, crop_box=[], eval_cls=None, lane=1):
+        box_size_range=[32, 96], channel=1, crop_box=[], eval_cls=None, lane=1, vis_canvas="full"):
         
         viz25D=eval2D
         viz3D=False
@@ -189,7 +205,7 @@ class Evaluator:
                 # print(filename)
                 # print(calibrationPath)
                 try:
-                    calib = Calibration(calibrationPath)
+                    calib = load_calibration(calibrationPath, Calibration)
                 # print(calib.c_u,calib.c_v)
                 except:
                     calib = None
@@ -394,33 +410,31 @@ class Evaluator:
                 
             if (eval2D or eval3D) and (viz25D or vizGT or viz3D):
                 img = cv2.imread(imgpath)
+                img_h, img_w = img.shape[:2]
+                scale_first = vis_canvas == "scaled"
                 
                 if viz25D:
                     # print("VIZ25D")
                     os.makedirs(os.path.join(self.save_dir, "25D"),exist_ok=True)
-                    img_2_3 = img.copy()
+                    ## 画布为输出尺寸(宽1200)，scaled模式下先缩放再绘制
+                    canvas_2_3 = get_canvas("eval_25D_det", (1200, int(img_h * 1200 / img_w)), scale_first)
+                    img_2_3 = canvas_2_3.begin(img)
                     if vizGT:
-                        img_2_2 = img.copy()
+                        canvas_2_2 = get_canvas("eval_25D_gt", (1200, int(img_h * 1200 / img_w)), scale_first)
+                        img_2_2 = canvas_2_2.begin(img)
                 
                 if viz3D:
                     os.makedirs(os.path.join(self.save_dir, "3D"),exist_ok=True)
+                    canvas_2 = get_canvas("eval_3D_gt", (800, int(img_h * 800 / img_w)), scale_first)
+                    img2 = canvas_2.begin(img) # 3d box graph
+                    canvas_3 = get_canvas("eval_3D_det", (800, int(img_h * 800 / img_w)), scale_first)
+                    img = canvas_3.begin(img)
                     ## bev图
-                    img2 = img.copy() # 3d box graph
-                    metric_width, metric_height = 800, 800
+                    metric_width = 800
                     worldsize = 160
-                    polar_step_size_meters = 10
-                    pixels_per_meter = metric_height//worldsize # 每米5个pixel 
-                    center_pixel = ( metric_width//2, metric_height)
-                    img4 = np.ones((metric_width, metric_height, 3), dtype=np.uint8) * 230
-                    # # Draw metric polar grid
-                    for i in range(1, int(metric_width/(polar_step_size_meters*pixels_per_meter))):
-                        cv2.circle(
-                            img4, center_pixel, int(i * polar_step_size_meters*pixels_per_meter ),
-                            (50, 50, 50), 2)
-                        cv2.line(img4, (0, center_pixel[1]-int(i * polar_step_size_meters*pixels_per_meter )), (metric_width, center_pixel[1]-int(i * polar_step_size_meters*pixels_per_meter )), (200, 200, 200))
-                        cv2.line(img4, (abs(int(i * polar_step_size_meters*pixels_per_meter )),0), (abs(int(i * polar_step_size_meters*pixels_per_meter )),metric_height), (200, 200, 200))
-                
-                
+                    img4 = new_bev_map(metric_width, worldsize)
+                    bev_gt_corners, bev_gt_ids = [], []
+                    bev_det_corners, bev_det_colors, bev_det_ids = [], [], []
                 
                 if objs != None:
                     for i,(obj, miss_flag) in enumerate(zip(objs, miss_flags)):
@@ -434,12 +448,13 @@ class Evaluator:
                                 corners_3d = obj.generate_corners3d()
                                 # if obj.w ==0.0: # show that obj only has 2d box 
                                     # img2 = cv2.rectangle(img2, (int(obj.box2d[0]), int(obj.box2d[1])), (int(obj.box2d[2]), int(obj.box2d[3])), color=(0, 255, 255), thickness=5)
-                                img4 = draw_bev_box3d(img4, corners_3d[np.newaxis, :], obj.id, thickness=2, color=(255, 0, 0), scores=None, world_size=worldsize,out_size=metric_width) # circ pos
+                                bev_gt_corners.append(corners_3d) # circ pos
+                                bev_gt_ids.append(obj.id)
                                 corners_2d, depth = calib.project_rect_to_image(corners_3d)
-                                img2 = draw_projected_box3d(img2, corners_2d, obj.id, cls=obj.type, color=colors[obj.type], draw_orientation=True,draw_corner=False) # 3d box
+                                img2 = draw_projected_box3d(img2, canvas_2.points(corners_2d), obj.id, cls=obj.type, color=colors[obj.type], thickness=canvas_2.thickness(2), draw_orientation=True,draw_corner=False) # 3d box
                             if crop_box != []:
-                                img = draw_2d(img, [calib.c_u-crop_box[1]//2,calib.c_v-crop_box[0]//2,calib.c_u+crop_box[1]//2,calib.c_v+crop_box[0]//2])
-                                img = draw_point(img,[calib.c_u,calib.c_v])
+                                img = draw_2d(img, canvas_3.box([calib.c_u-crop_box[1]//2,calib.c_v-crop_box[0]//2,calib.c_u+crop_box[1]//2,calib.c_v+crop_box[0]//2]), canvas_3.thickness(10))
+                                img = draw_point(img, canvas_3.point([calib.c_u,calib.c_v]), canvas_3.thickness(10), canvas_3.thickness(2))
                         if viz25D and vizGT:
                             if miss_flag == 1:
                                 color_gt = (0,255,255)
@@ -448,15 +463,15 @@ class Evaluator:
                             else:
                                 color_gt = (0, 0, 255)
                             # print(2)
-                            img_2_2 = cv2.rectangle(img_2_2, (int(obj.box2d[0]), int(obj.box2d[1])),
-                                                (int(obj.box2d[2]), int(obj.box2d[3])), color=color_gt, thickness=3)
+                            box2d = canvas_2_2.box(obj.box2d).astype(int)
+                            img_2_2 = cv2.rectangle(img_2_2, (box2d[0], box2d[1]),
+                                                (box2d[2], box2d[3]), color=color_gt, thickness=canvas_2_2.thickness(3))
                             # print(obj.keypoint_down)
-                            img_2_2 = draw_boxcube(img_2_2, obj)
-                            cv2.putText(img_2_2, '{}'.format(obj.type), tuple(obj.box2d[0:2].astype(int)), cv2.FONT_HERSHEY_SIMPLEX, 
-                                                   1, (255, 100, 0), 2, cv2.LINE_AA)
-                            cv2.putText(img_2_2, '{}'.format(int(box_size)), tuple(obj.box2d[[0,3]].astype(int)), cv2.FONT_HERSHEY_SIMPLEX, 
-                                                   1, (255, 100, 0), 2, cv2.LINE_AA)
-                            cv2.putText(img_2_2, 'GT', (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 2, (0, 0, 255), 2)
+                            img_2_2 = draw_boxcube(img_2_2, obj, canvas_2_2.thickness(4), canvas_2_2.thickness(3), canvas_2_2.scale_xy)
+                            cv2.putText(img_2_2, '{}'.format(obj.type), tuple(box2d[0:2]), cv2.FONT_HERSHEY_SIMPLEX, 
+                                                   canvas_2_2.font_scale(1), (255, 100, 0), canvas_2_2.thickness(2), cv2.LINE_AA)
+                            cv2.putText(img_2_2, '{}'.format(int(box_size)), tuple(box2d[[0,3]]), cv2.FONT_HERSHEY_SIMPLEX, 
+                                                   canvas_2_2.font_scale(1), (255, 100, 0), canvas_2_2.thickness(2), cv2.LINE_AA)
                             
                     
                 if objs_det != None:
@@ -466,48 +481,54 @@ class Evaluator:
                             if viz3D:
                                 corners_3d_det = obj_det.generate_corners3d()
                                 # print("l, h, w, t, ry: ", obj_det.l, obj_det.h, obj_det.w,obj_det.t,obj_det.ry)
-                                img4 = draw_bev_box3d(img4, corners_3d_det[np.newaxis, :], obj_det.id, thickness=2, color=colors[obj_det.type], scores=None,world_size=worldsize,out_size=metric_width)
+                                bev_det_corners.append(corners_3d_det)
+                                bev_det_colors.append(colors[obj_det.type])
+                                bev_det_ids.append(obj_det.id)
                                 # print(obj_det.box2d)
                                 # img = cv2.rectangle(img, (int(obj_det.box2d[0]), int(obj_det.box2d[1])), (int(obj_det.box2d[2]), int(obj_det.box2d[3])), color=(0, 255, 255), thickness=3)
                                 corners_2d_det, depth = calib.project_rect_to_image(corners_3d_det)
-                                img = draw_projected_box3d(img, corners_2d_det, obj_det.id, cls=obj_det.type, color=colors[obj_det.type], draw_orientation=False,draw_corner=False)
+                                img = draw_projected_box3d(img, canvas_3.points(corners_2d_det), obj_det.id, cls=obj_det.type, color=colors[obj_det.type], thickness=canvas_3.thickness(2), draw_orientation=False,draw_corner=False)
                         
                         if viz25D:
                             if false_flag == 1:
                                 color_det = (0,255,255)
                             else:
                                 color_det = (0,0,255)
-                            img_2_3 = cv2.rectangle(img_2_3, (int(obj_det.box2d[0]), int(obj_det.box2d[1])),
-                                                (int(obj_det.box2d[2]), int(obj_det.box2d[3])), color=color_det, thickness=3)
-                            img_2_3 = draw_boxcube(img_2_3, obj_det)
-                            cv2.putText(img_2_3, '{}'.format(obj_det.type), tuple(obj_det.box2d[0:2].astype(int)), cv2.FONT_HERSHEY_SIMPLEX, 
-                                                   1, (255, 100, 0), 2, cv2.LINE_AA)
+                            box2d = canvas_2_3.box(obj_det.box2d).astype(int)
+                            img_2_3 = cv2.rectangle(img_2_3, (box2d[0], box2d[1]),
+                                                (box2d[2], box2d[3]), color=color_det, thickness=canvas_2_3.thickness(3))
+                            img_2_3 = draw_boxcube(img_2_3, obj_det, canvas_2_3.thickness(4), canvas_2_3.thickness(3), canvas_2_3.scale_xy)
+                            cv2.putText(img_2_3, '{}'.format(obj_det.type), tuple(box2d[0:2]), cv2.FONT_HERSHEY_SIMPLEX, 
+                                                   canvas_2_3.font_scale(1), (255, 100, 0), canvas_2_3.thickness(2), cv2.LINE_AA)
                             # print(box_size)
-                            cv2.putText(img_2_3, '{}'.format(int(box_size)), tuple(obj_det.box2d[[0,3]].astype(int)), cv2.FONT_HERSHEY_SIMPLEX, 
-                                                   1, (255, 100, 0), 2, cv2.LINE_AA)  
+                            cv2.putText(img_2_3, '{}'.format(int(box_size)), tuple(box2d[[0,3]]), cv2.FONT_HERSHEY_SIMPLEX, 
+                                                   canvas_2_3.font_scale(1), (255, 100, 0), canvas_2_3.thickness(2), cv2.LINE_AA)  
                 # INFER-GT img
                 if  viz25D:
                     if vizGT:
-                        cv2.putText(img_2_3, 'INFER', (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 2, (0, 255, 255), 2)
-                        img_2_3 = cv2.resize(img_2_3, (1200, int(img_2_3.shape[0] * 1200 / img_2_3.shape[1])))
-                        img_2_2 = cv2.resize(img_2_2, (1200, int(img_2_2.shape[0] * 1200 / img_2_2.shape[1])))
-                        img_array_2 = np.concatenate((img_2_2, img_2_3), axis=1)
+                        cv2.putText(img_2_2, 'GT', (50, 50), cv2.FONT_HERSHEY_SIMPLEX, canvas_2_2.font_scale(2), (0, 0, 255), canvas_2_2.thickness(2))
+                        cv2.putText(img_2_3, 'INFER', (50, 50), cv2.FONT_HERSHEY_SIMPLEX, canvas_2_3.font_scale(2), (0, 255, 255), canvas_2_3.thickness(2))
+                        img_array_2 = np.concatenate((canvas_2_2.finish(), canvas_2_3.finish()), axis=1)
                         cv2.imwrite(os.path.join(self.save_dir, "25D", filename.split('/')[-1]), img_array_2)
                     else:
-                        img_2_3 = cv2.resize(img_2_3, (1200, int(img_2_3.shape[0] * 1200 / img_2_3.shape[1])))
-                        cv2.imwrite(os.path.join(self.save_dir, "25D", filename.split('/')[-1]), img_2_3)
+                        cv2.imwrite(os.path.join(self.save_dir, "25D", filename.split('/')[-1]), canvas_2_3.finish())
                 if viz3D:
-                    img3 = cv2.resize(img,(800,int(img.shape[0]*800/img.shape[1])))
-                    img2 = cv2.resize(img2,(800,int(img2.shape[0]*800/img2.shape[1])))
-                    img_array = np.concatenate((img3, img2), axis=0) 
+                    ## gt蓝色，检测按类别颜色
+                    img4 = draw_bev_boxes(img4, bev_gt_corners, (255, 0, 0), bev_gt_ids, world_size=worldsize, out_size=metric_width)
+                    img4 = draw_bev_boxes(img4, bev_det_corners, bev_det_colors, bev_det_ids, world_size=worldsize, out_size=metric_width)
+                    img_array = np.concatenate((canvas_3.finish(), canvas_2.finish()), axis=0) 
                     img4 = cv2.resize(img4,(int(img4.shape[1]/img4.shape[0]*img_array.shape[0]),img_array.shape[0]))
                     img_array = np.concatenate((img4, img_array), axis=1) 
-                    cv2.imwrite(cv2.imwrite(os.path.join(self.save_dir, "3D", filename.split('/')[-1]),img_array))
+                    cv2.imwrite(os.path.join(self.save_dir, "3D", filename.split('/')[-1]),img_array)
                     
         cal_metrics = True
+        summary = {}
         if cal_metrics:
             print("="*20)
             print("RESULTS:")
+            # err_items is written without eval2D as well
+            metrics_dir = os.path.join(self.save_dir, "metrics")
+            os.makedirs(metrics_dir, exist_ok=True)
             if eval3D:
                 tp_list_new =sum_list(tp_list, channel, x_dim)
                 fn_list_new = sum_list(fn_list,channel, x_dim)
@@ -558,6 +579,20 @@ class Evaluator:
                     pre_iou_list_new,pre_num_list_new, false_rate, 
                     depth_error, shape_error, yaw_error, channel)
                 
+                # totals over all lanes and depth channels, to compare two models
+                num_gt, num_pre = float(np.sum(gt_num_list_new)), float(np.sum(pre_num_list_new))
+                num_depth = float(np.sum(depth_list_new))
+                summary = {
+                    "gt": int(num_gt),
+                    "pre": int(num_pre),
+                    "tp": int(np.sum(tp_list_new)),
+                    "miss_rate": float(np.sum(fn_list_new)) / num_gt if num_gt > 0 else 0.0,
+                    "false_rate": float(np.sum(pre_iou_list_new)) / num_pre if num_pre > 0 else 0.0,
+                    "depth_error": float(np.sum(depth_abs_list_new)) / num_depth if num_depth > 0 else 0.0,
+                }
+                with open(os.path.join(metrics_dir, "summary.json"), 'w') as f:
+                    f.write(json.dumps(summary, indent=2))
+                
             if eval2D:    
                 # 处理按类
                 clses = list(cls_gt_num_list.keys())
@@ -579,8 +614,6 @@ class Evaluator:
                 print("类预测数量",cls_pre_num_list)
                 # toxlsx_cls(savepath_cls, cls_tp_list, cls_fn_list, cls_pre_iou_list, cls_pre_num_list, cls_gt_num_list)
                 
-                metrics_dir = os.path.join(self.save_dir, "metrics")
-                os.makedirs(metrics_dir, exist_ok=True)
                 with open(os.path.join(metrics_dir, "box_tp_list.txt"), 'w') as f:
                     f.write(json.dumps(box_tp_list))
                 with open(os.path.join(metrics_dir, "box_fn_list.txt"), 'w') as f:
@@ -614,6 +647,8 @@ class Evaluator:
             
             if eval2D and video:
                 merge_video(self.save_dir, os.path.join(self.save_dir, "25D"))
+        # with eval3D, overall miss / false detection rates and relative depth error
+        return summary
     # print(get_average(relative_error))
     # print(sum(absolute_error)/sum(gt_depth))
     def evaluate2D(self):
@@ -893,6 +928,7 @@ def setup_eval_args():
     parser.add_argument("--image_size", type=int, default=[1936, 1220], nargs=2, help="Original image size")
     parser.add_argument("--crop", type=int, default=[8, 28, 1928, 1220], nargs=4, help="Diagonal coordinates of crop box")
     parser.add_argument("--cls", type=str, default=None, nargs='+', help="Classes to evaluate")
+    parser.add_argument("--vis_canvas", type=str, default="full", choices=VIS_CANVAS_MODES, help="draw on the original image then resize it (full), or resize first and draw scaled geometry on a reused output buffer (scaled)")
     return parser
     
     
@@ -928,4 +964,4 @@ if __name__ == "__main__":
 
     evaluator = Evaluator(test_file, save_dir, gt_path, det_path, 
                           img_shape, crop_coor, calib_path)
-    evaluator.evaluate(eval2D, eval25D, eval3D, vizGT, video, box_size_range, channel, eval_cls)
\ No newline at end of file
+    evaluator.evaluate(eval2D, eval25D, eval3D, vizGT, video, box_size_range, channel, eval_cls, vis_canvas=args.vis_canvas)
\ No newline at end of file
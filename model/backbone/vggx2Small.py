@@ -1,6 +1,7 @@
 from torch import nn
 from model.backbone.vggx2Small_fpn import Vggx2SmallDeconvFPN
 import torch
+from torch.autograd.profiler import record_function
 
 class Vggx2SmallNet(nn.Module):
     def __init__(self,  width_mult=1., out_stages=(2, ), last_channel=1280, activation='ReLU6'):
@@ -95,16 +96,22 @@ class Vggx2SmallNet(nn.Module):
                 m.bias.data.zero_()
 
     def forward(self,x):
+        # record_function: stage names in the --profile trace
         output = []
-        out1 = self.layer1(x)
+        with record_function("Vggx2SmallNet.layer1"):
+            out1 = self.layer1(x)
         output.append(out1)
-        out2 = self.layer2(out1)
+        with record_function("Vggx2SmallNet.layer2"):
+            out2 = self.layer2(out1)
         output.append(out2)
-        out3 = self.layer3(out2)
+        with record_function("Vggx2SmallNet.layer3"):
+            out3 = self.layer3(out2)
         output.append(out3)
-        out4 = self.layer4(out3)
+        with record_function("Vggx2SmallNet.layer4"):
+            out4 = self.layer4(out3)
         output.append(out4)
-        out5 = self.layer5(out4)
+        with record_function("Vggx2SmallNet.layer5"):
+            out5 = self.layer5(out4)
         output.append(out5)
         
         return tuple(output)
@@ -12,6 +12,7 @@ import logging
 import numpy as np
 import torch
 import torch.nn as nn
+from torch.autograd.profiler import record_function
 
 BN_MOMENTUM = 0.1
 
@@ -146,9 +147,14 @@ class Vggx2SmallDeconvFPN(nn.Module):
 
 
     def forward(self, input):
-        out = self.deconv_layer1(input[4]) + input[3]
-        out = self.deconv_layer2(out) + input[2]
-        out = self.deconv_layer3(out) + input[1]
-        out = self.deconv_layer4(out) + input[0]
-        out = self.layer(out)
+        with record_function("Vggx2SmallDeconvFPN.deconv1"):
+            out = self.deconv_layer1(input[4]) + input[3]
+        with record_function("Vggx2SmallDeconvFPN.deconv2"):
+            out = self.deconv_layer2(out) + input[2]
+        with record_function("Vggx2SmallDeconvFPN.deconv3"):
+            out = self.deconv_layer3(out) + input[1]
+        with record_function("Vggx2SmallDeconvFPN.deconv4"):
+            out = self.deconv_layer4(out) + input[0]
+        with record_function("Vggx2SmallDeconvFPN.out"):
+            out = self.layer(out)
         return out
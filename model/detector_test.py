@@ -0,0 +1,23 @@
+from torch import nn
+
+from model.backbone import build_backbone
+from model.head.detector_predictor_test import make_predictor
+
+
+class KeypointDetector_v2(nn.Module):
+    '''
+    Generalized structure for keypoint based object detector.
+    main parts:
+    - backbone
+    - heads
+    '''
+
+    def __init__(self, cfg):
+        super(KeypointDetector_v2, self).__init__()
+        self.backbone = build_backbone(cfg)
+        self.heads = make_predictor(cfg, self.backbone.out_channels)
+
+    def forward(self, images):
+        features = self.backbone(images)
+        output_cls,  output_regs= self.heads(features)
+        return output_cls,  output_regs
@@ -6,6 +6,7 @@ import pdb
 from torch import imag, nn
 from shapely.geometry import Polygon
 from torch.nn import functional as F
+from torch.autograd.profiler import record_function
 from model.layers.utils import (
     nms_hm,
     select_topk,
@@ -15,7 +16,11 @@ from model.layers.utils import (
 PI = np.pi
 
 class postprocess(nn.Module):
-    def __init__(self,input_width=640,input_height=320, det_thres=0.29):
+    def __init__(self,input_width=640,input_height=320, det_thres=0.29, dim_mean=None, dim_std=None):
+        """
+            dim_mean / dim_std: per-class 3d dimension priors, default the ones of
+            the current training set (e.g. the metadata of an exported artifact)
+        """
         super(postprocess, self).__init__()
         self.regression_head_cfg = [['2d_dim'], ['3d_offset'],['corner_offset'],['3d_dim'], ['ori_cls', 'ori_offset'], ['depth']]
         self.regression_channel_cfg = [[4, ], [2, ], [20], [3, ], [8, 8], [1, ]]
@@ -24,7 +29,8 @@ class postprocess(nn.Module):
         self.down_ratio = 4
         self.depth_mode = 'inv_sigmoid'
         self.depth_range =  [0.1, 200]
-        self.alpha_centers = torch.tensor([0, PI / 2, PI, - PI / 2]).to('cuda') 
+        # buffers follow the module on .to(device), so postprocess runs on cpu or cuda
+        self.register_buffer('alpha_centers', torch.tensor([0, PI / 2, PI, - PI / 2]), persistent=False)
         self.multibin = True
         self.orien_bin_size = 4
         self.dim_modes = ['exp', True, False]
@@ -33,7 +39,7 @@ class postprocess(nn.Module):
         self.max_detection = 50 
         self.head_conv = 256
         self.det_threshold = det_thres ## 0.25改为0.29
-        self.dim_mean =  torch.as_tensor(((3.99331126, 1.54370861, 1.64175497),
+        self.register_buffer('dim_mean', torch.as_tensor(((3.99331126, 1.54370861, 1.64175497),
                                (0.295, 1.6, 0.3175),
                                (1.34645161, 1.55322581, 0.3883871),
                                (2.503, 1.72 , 1.077),
@@ -41,8 +47,8 @@ class postprocess(nn.Module):
                                (10.3655102,3.31632653,2.45469388),
                                (6.016911083,3.412001685,2.2783185),
                                (4.824963,2.046904,1.78939),
-                                (8.8040879,2.9161930,2.07649252))).to('cuda')
-        self.dim_std =  torch.as_tensor(((0.35223078,0.19156938,0.12989004),
+                                (8.8040879,2.9161930,2.07649252))), persistent=False)
+        self.register_buffer('dim_std', torch.as_tensor(((0.35223078,0.19156938,0.12989004),
                                 (0.08789198,0.14142136,0.06647368),
                                 (0.23795565,0.06148103,0.05400698),
                                 (0.60405381,0.07483315,0.22275772),
@@ -50,21 +56,22 @@ class postprocess(nn.Module):
                                 (2.53467307,0.54747917,0.31232572),
                                (3.68131074,1.02058,0.6805663),
                                 (1.232056,0.318495,0.242334),
-                               (4.68605842,1.237353625,0.853123))).to('cuda')
+                               (4.68605842,1.237353625,0.853123))), persistent=False)
+        if dim_mean is not None:
+            self.dim_mean = torch.as_tensor(dim_mean, dtype=self.dim_mean.dtype)
+        if dim_std is not None:
+            self.dim_std = torch.as_tensor(dim_std, dtype=self.dim_std.dtype)
 
     
     def decode_dimension(self, cls_id, dims_offset):
         cls_id = cls_id.flatten().long()
-        if cls_id.is_cuda is False:
-            cls_dimension_mean = self.dim_mean[cls_id, :].to('cpu')
-        else:
-            cls_dimension_mean = self.dim_mean[cls_id, :]
+        cls_dimension_mean = self.dim_mean[cls_id, :].to(dims_offset.device)
 
         if self.dim_modes[0] == 'exp':
             dims_offset = dims_offset.exp()
 
         if self.dim_modes[2]:
-            cls_dimension_std = self.dim_std[cls_id, :]
+            cls_dimension_std = self.dim_std[cls_id, :].to(dims_offset.device)
             dimensions = dims_offset * cls_dimension_std + cls_dimension_mean
         else:
             dimensions = dims_offset * cls_dimension_mean
@@ -88,7 +95,7 @@ class postprocess(nn.Module):
         return depth
 
     def decode_location_flatten(self, points, offsets, depths, calibs, batch_idxs):
-        batch_size = 1# len(calibs)
+        # calibs: a single Calibration, or one Calibration per image of the batch
         gts = torch.unique(batch_idxs, sorted=True).tolist()
         # locations = points.new_zeros(points.shape[0], 3).float()
         locations = torch.zeros((points.shape[0], 3), dtype=points.dtype, device=points.device).float()
@@ -96,7 +103,7 @@ class postprocess(nn.Module):
 
         for idx, gt in enumerate(gts):
             corr_pts_idx = torch.nonzero(batch_idxs == gt).squeeze(-1)
-            calib = calibs
+            calib = calibs[gt] if isinstance(calibs, (list, tuple)) else calibs
             # print("calib P", calib.P,calib.b_x,calib.b_y, calib.f_u, calib.f_v, calib.c_u, calib.c_v)
             # pdb.set_trace()
             # concatenate uv with depth
@@ -219,12 +226,36 @@ class postprocess(nn.Module):
         return torch.as_tensor(valid_mask)
 
     def forward(self,output_cls,output_regs,calib):
+        """
+            calib: Calibration of a single image, or a list with one Calibration per image.
+            With a single Calibration the results of the first image are returned as before,
+            with a list, a list of per-image results is returned.
+        """
+        batched = isinstance(calib, (list, tuple))
+        results = self.forward_batch(output_cls, output_regs, calib if batched else [calib])
+        return results if batched else results[0]
+
+    def forward_batch(self,output_cls,output_regs,calibs):
+        batch, _, output_h, output_w = output_cls.shape
+        empty_result = (None,) * 11
+        # the model may run under fp16 / bf16 autocast, the peaks and every decode
+        # step (inverse sigmoid depth, orientation, image to rect projection) stay fp32
+        output_cls = output_cls.float()
 
-        heatmap = nms_hm(output_cls,kernel=5)
-        scores, indexs, clses, ys, xs = select_topk(heatmap, K=self.max_detection)
+        # record_function: stage names in the --profile trace
+        with record_function("postprocess.nms_topk"):
+            heatmap = nms_hm(output_cls,kernel=5)
+            scores, indexs, clses, ys, xs = select_topk(heatmap, K=self.max_detection)
         
-        pred_bbox_points = torch.cat([xs.view(-1, 1), ys.view(-1, 1)], dim=1)
-        pred_regression_pois = select_point_of_interest(output_regs.shape[0], indexs, output_regs).view(-1, output_regs.shape[1])
+        with record_function("postprocess.gather"):
+            pred_bbox_points = torch.cat([xs.view(-1, 1), ys.view(-1, 1)], dim=1)
+            if isinstance(output_regs, torch.Tensor):
+                pred_regression_pois = select_point_of_interest(batch, indexs, output_regs).view(-1, output_regs.shape[1])
+            else:
+                # SparseRegression of predictor.forward_sparse, the heads run at the peaks only
+                pred_regression_pois = output_regs.select(batch, indexs).view(-1, output_regs.num_channels)
+            pred_regression_pois = pred_regression_pois.float()
+        batch_idxs = torch.arange(batch, device=scores.device).view(-1, 1).expand_as(scores).reshape(-1)
         scores = scores.view(-1)
         indexs = indexs.view(-1)
         # print("score", scores)
@@ -232,7 +263,7 @@ class postprocess(nn.Module):
         # print(valid_mask)
         # pdb.set_trace()
         if valid_mask.sum() == 0:
-            return None,None,None,None,None,None,None,None,None,None,None 
+            return [empty_result] * batch
         
         visualize_preds ={}
         clses = clses.view(-1)[valid_mask]
@@ -242,8 +273,11 @@ class postprocess(nn.Module):
         pred_regression_pois = pred_regression_pois[valid_mask]
         scores = scores[valid_mask]
         indexs = indexs[valid_mask]
+        batch_idxs = batch_idxs[valid_mask]
         
-        valid_mask_duplicate = self.del_dul_id(clses, indexs)
+        # peaks are only duplicated within the same image
+        with record_function("postprocess.del_dul_id"):
+            valid_mask_duplicate = self.del_dul_id(clses, batch_idxs * output_h * output_w + indexs)
         #print(valid_mask_duplicate)
         clses = clses[valid_mask_duplicate]
         # print(clses)
@@ -251,6 +285,7 @@ class postprocess(nn.Module):
         pred_regression_pois = pred_regression_pois[valid_mask_duplicate]
         scores = scores[valid_mask_duplicate]
         indexs = indexs[valid_mask_duplicate]
+        batch_idxs = batch_idxs[valid_mask_duplicate]
         # print(scores)
 #         print("indexs ",indexs)
 #         print("pred_regression_pois.shape : ",pred_regression_pois.shape)
@@ -264,12 +299,15 @@ class postprocess(nn.Module):
 
         ppred_bbox_points = pred_bbox_points + pred_offset_3D
         
-        pred_box2d = self.decode_box2d_fcos(ppred_bbox_points, pred_2d_reg)
+        with record_function("postprocess.decode_box2d"):
+            pred_box2d = self.decode_box2d_fcos(ppred_bbox_points, pred_2d_reg)
         
-        pred_dimensions = self.decode_dimension(clses, pred_dimensions_offsets)
+        with record_function("postprocess.decode_dimension"):
+            pred_dimensions = self.decode_dimension(clses, pred_dimensions_offsets)
         # print("pred_dimensions ",pred_dimensions)
         pred_depths_offset = pred_regression_pois[:, 41].squeeze(-1)
-        pred_depths = self.decode_depth(pred_depths_offset)
+        with record_function("postprocess.decode_depth"):
+            pred_depths = self.decode_depth(pred_depths_offset)
         # print("pred_depths ",pred_depths)
         pred_depths = pred_depths.reshape(-1)
         pred_keypoint_offset = pred_regression_pois[:, 6:14]
@@ -304,10 +342,11 @@ class postprocess(nn.Module):
         pred_keypoint_visible = torch.softmax(pred_keypoint_visible, dim=2)
         pred_keypoint_visible = pred_keypoint_visible[:,:, 0] < pred_keypoint_visible[:,:, 1]
         # print("pred_keypoint_visible: ",pred_keypoint_visible.shape)
-        batch_idxs = pred_depths.new_zeros(pred_depths.shape[0]).long()
-        pred_locations = self.decode_location_flatten(pred_bbox_points, pred_offset_3D, pred_depths, calib, batch_idxs)
+        with record_function("postprocess.decode_location"):
+            pred_locations = self.decode_location_flatten(pred_bbox_points, pred_offset_3D, pred_depths, calibs, batch_idxs)
         # print("pred_locations :",pred_locations)
-        pred_rotys, pred_alphas = self.decode_axes_orientation(pred_orientation, pred_locations)
+        with record_function("postprocess.decode_orientation"):
+            pred_rotys, pred_alphas = self.decode_axes_orientation(pred_orientation, pred_locations)
         # print("pred_rotys : ",pred_rotys, " pred_alphas : ",pred_alphas)
         pred_locations[:, 1] += pred_dimensions[:, 1] / 2
         clses = clses.view(-1, 1)
@@ -318,8 +357,19 @@ class postprocess(nn.Module):
         pred_dimensions = pred_dimensions.roll(shifts=-1, dims=1)
         ppred_bbox_points = pred_bbox_points*4
         
+        outputs = (clses,pred_alphas,pred_rotys, pred_box2d, pred_dimensions,scores ,pred_locations,pred_keypoint,pred_keypoint_visible,ppred_bbox_points,pred_center_type)
         
-        return clses,pred_alphas,pred_rotys, pred_box2d, pred_dimensions,scores ,pred_locations,pred_keypoint,pred_keypoint_visible,ppred_bbox_points,pred_center_type
+        # split the flattened detections back to their images
+        results = []
+        with record_function("postprocess.split"):
+            for b in range(batch):
+                image_mask = batch_idxs == b
+                if image_mask.sum() == 0:
+                    results.append(empty_result)
+                else:
+                    results.append(tuple(output[image_mask] for output in outputs))
+
+        return results
 
 
 
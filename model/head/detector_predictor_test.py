@@ -6,6 +6,8 @@ import pdb
 import numpy as np
 from torch import nn
 from torch.nn import functional as F
+from torch.autograd.profiler import record_function
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 from utils.registry import Registry
 from model import registry
@@ -112,26 +114,205 @@ class _predictor(nn.Module):
             )
 
     def forward(self, features):
-        b, c, h, w = features.shape
-
         # output classification
-        feature_cls = self.class_head[:-1](features)
-        output_cls = self.class_head[-1](feature_cls)
+        with record_function("predictor.class_head"):
+            feature_cls = self.class_head[:-1](features)
+            output_cls = self.class_head[-1](feature_cls)
 
         output_regs = []
         # output regression
-        for i, reg_feature_head in enumerate(self.reg_features):
-            reg_feature = reg_feature_head(features)
+        with record_function("predictor.reg_heads"):
+            for i, reg_feature_head in enumerate(self.reg_features):
+                reg_feature = reg_feature_head(features)
 
-            for j, reg_output_head in enumerate(self.reg_heads[i]):
-                output_reg = reg_output_head(reg_feature)
-                output_regs.append(output_reg)
+                for j, reg_output_head in enumerate(self.reg_heads[i]):
+                    output_reg = reg_output_head(reg_feature)
+                    output_regs.append(output_reg)
 
-        output_cls = sigmoid_hm(output_cls)
-        output_regs = torch.cat(output_regs, dim=1)
+        with record_function("predictor.outputs"):
+            output_cls = sigmoid_hm(output_cls)
+            output_regs = torch.cat(output_regs, dim=1)
 
         return  output_cls,  output_regs
 
+    def forward_cls(self, features):
+        with record_function("predictor.class_head"):
+            feature_cls = self.class_head[:-1](features)
+            output_cls = self.class_head[-1](feature_cls)
+        return sigmoid_hm(output_cls)
+
+    def forward_sparse(self, features):
+        '''
+        Dense heatmap, and the regression heads as a SparseRegression that
+        postprocess evaluates at the top-K peaks only.
+        '''
+        if self.enable_edge_fusion:
+            raise ValueError("the regression heads of a predictor with edge fusion can not be evaluated sparsely")
+        return self.forward_cls(features), SparseRegression(features, list(zip(self.reg_features, self.reg_heads)))
+
+class FusedPredictor(nn.Module):
+    '''
+    Inference-only _predictor with the regression branches fused horizontally:
+    the 3x3 reg_features convs of all groups are one wide conv (their BN folded
+    in), and the 1x1 output heads one grouped conv over it, padded to the widest
+    group. Built from a loaded _predictor with from_predictor, the outputs are
+    the same up to float rounding.
+    '''
+
+    def __init__(self, class_head, reg_feature, reg_head, keep=None):
+        super(FusedPredictor, self).__init__()
+        self.class_head = class_head
+        self.reg_features = nn.Sequential(reg_feature, nn.ReLU(inplace=True))
+        self.reg_heads = reg_head
+        # output channels of reg_heads that are not padding, None if all are
+        if keep is not None:
+            self.register_buffer('keep', keep)
+        else:
+            self.keep = None
+
+    @classmethod
+    def from_predictor(cls, predictor):
+        if predictor.enable_edge_fusion:
+            raise ValueError("the regression heads of a predictor with edge fusion can not be fused")
+        if predictor.training:
+            raise ValueError("the regression heads can only be fused in eval mode")
+
+        ## one wide 3x3 conv, BN folded
+        convs = []
+        for feat_layer in predictor.reg_features:
+            conv, norm = feat_layer[0], feat_layer[1]
+            if isinstance(norm, nn.BatchNorm2d):
+                conv = fuse_conv_bn_eval(conv, norm)
+            elif not isinstance(norm, nn.Identity):
+                raise ValueError("only BN (or already folded) reg_features can be fused, not {}".format(type(norm).__name__))
+            convs.append(conv)
+        first = convs[0]
+        reg_feature = nn.Conv2d(first.in_channels, sum(conv.out_channels for conv in convs), first.kernel_size,
+                                stride=first.stride, padding=first.padding, bias=True).to(first.weight.device)
+        reg_feature.weight.data.copy_(torch.cat([conv.weight.data for conv in convs], dim=0))
+        reg_feature.bias.data.copy_(torch.cat([conv.bias.data if conv.bias is not None else torch.zeros_like(conv.weight.data[:, 0, 0, 0])
+                                               for conv in convs], dim=0))
+
+        ## one grouped 1x1 conv, every group padded to the widest one
+        group_weights, group_biases = [], []
+        for head_list in predictor.reg_heads:
+            group_weights.append(torch.cat([head.weight.data for head in head_list], dim=0))
+            group_biases.append(torch.cat([head.bias.data for head in head_list], dim=0))
+        num_groups = len(group_weights)
+        max_channels = max(weight.shape[0] for weight in group_weights)
+        head_conv = group_weights[0].shape[1]
+        reg_head = nn.Conv2d(num_groups * head_conv, num_groups * max_channels, kernel_size=1, groups=num_groups,
+                             bias=True).to(first.weight.device)
+        reg_head.weight.data.zero_()
+        reg_head.bias.data.zero_()
+        keep = []
+        for idx, (weight, bias) in enumerate(zip(group_weights, group_biases)):
+            start = idx * max_channels
+            reg_head.weight.data[start:start + weight.shape[0]] = weight
+            reg_head.bias.data[start:start + weight.shape[0]] = bias
+            keep.extend(range(start, start + weight.shape[0]))
+        keep = None if len(keep) == num_groups * max_channels else torch.tensor(keep, device=first.weight.device)
+
+        return cls(predictor.class_head, reg_feature, reg_head, keep).eval()
+
+    def forward(self, features):
+        # output classification
+        with record_function("predictor.class_head"):
+            feature_cls = self.class_head[:-1](features)
+            output_cls = self.class_head[-1](feature_cls)
+
+        # output regression, all groups at once
+        with record_function("predictor.reg_heads"):
+            output_regs = self.reg_heads(self.reg_features(features))
+            if self.keep is not None:
+                output_regs = output_regs.index_select(1, self.keep)
+
+        with record_function("predictor.outputs"):
+            output_cls = sigmoid_hm(output_cls)
+
+        return  output_cls,  output_regs
+
+    def forward_cls(self, features):
+        with record_function("predictor.class_head"):
+            feature_cls = self.class_head[:-1](features)
+            output_cls = self.class_head[-1](feature_cls)
+        return sigmoid_hm(output_cls)
+
+    def forward_sparse(self, features):
+        ''' See _predictor.forward_sparse. '''
+        return self.forward_cls(features), SparseRegression(features, [(self.reg_features, [self.reg_heads])], self.keep)
+
+def gather_patches(features, index, kernel_size):
+    '''
+    kernel_size x kernel_size neighborhoods of features around index, zero padded
+    as the convolutions of the regression heads are.
+    Args:
+        features: [N, C, H, W]
+        index: [N, K] positions in H * W
+    Returns:
+        [N * K, C, kernel_size, kernel_size]
+    '''
+    batch, channel, height, width = features.shape
+    pad = kernel_size // 2
+    padded = F.pad(features, (pad, pad, pad, pad))
+    padded_width = width + 2 * pad
+    index = index.long()
+    num = index.shape[1]
+    # the window centered on (y, x) starts at (y, x) of the padded map
+    offsets = torch.arange(kernel_size, device=index.device)
+    offsets = (offsets.view(-1, 1) * padded_width + offsets.view(1, -1)).view(-1)
+    starts = torch.div(index, width, rounding_mode='trunc') * padded_width + index % width
+    flat_index = (starts.unsqueeze(-1) + offsets).view(batch, 1, -1).expand(batch, channel, -1)
+    patches = padded.flatten(2).gather(2, flat_index)
+    patches = patches.view(batch, channel, num, kernel_size, kernel_size).permute(0, 2, 1, 3, 4)
+    return patches.reshape(batch * num, channel, kernel_size, kernel_size)
+
+class SparseRegression(object):
+    '''
+    Regression heads of a predictor, evaluated by postprocess only at the peaks
+    it selected instead of at every output pixel: the receptive field of a head
+    output is the 3x3 neighborhood of its reg_features conv, so that conv runs
+    unpadded on the gathered neighborhoods and the rest of the branch on 1x1
+    maps. The values are those of the dense heads up to float rounding (the
+    convolutions accumulate in another order), the peaks are the same.
+    '''
+
+    def __init__(self, features, branches, keep=None):
+        '''
+        Args:
+            features: input of the heads, [N, C, H, W]
+            branches: (reg_feature Sequential starting with a conv, list of 1x1 output heads)
+            keep: output channels to keep, in order, None for all
+        '''
+        self.features = features
+        self.branches = branches
+        self.keep = keep
+        if keep is not None:
+            self.num_channels = len(keep)
+        else:
+            self.num_channels = sum(head.out_channels for _, heads in branches for head in heads)
+
+    def select(self, batch, index):
+        '''
+        Args:
+            index: [N, K] positions in H * W
+        Returns:
+            [N, K, C] head outputs at index, as select_point_of_interest of the dense outputs
+        '''
+        with record_function("predictor.sparse_reg_heads"):
+            first_conv = self.branches[0][0][0]
+            patches = gather_patches(self.features, index, first_conv.kernel_size[0])
+            outputs = []
+            for reg_feature_head, heads in self.branches:
+                conv = reg_feature_head[0]
+                reg_feature = F.conv2d(patches, conv.weight, conv.bias, groups=conv.groups)
+                reg_feature = reg_feature_head[1:](reg_feature)
+                outputs.extend(head(reg_feature) for head in heads)
+            outputs = torch.cat(outputs, dim=1)
+            if self.keep is not None:
+                outputs = outputs.index_select(1, self.keep)
+        return outputs.view(batch, -1, outputs.shape[1])
+
 def make_predictor(cfg, in_channels):
     func = registry.PREDICTOR[cfg.MODEL.HEAD.PREDICTOR]
     return func(cfg, in_channels)
\ No newline at end of file
@@ -82,8 +82,8 @@ def select_topk(heat_map, K=100):
     # topk_ys = (topk_inds_all // width).float()
     topk_xs = (topk_inds_all % width).float()
 
-    assert isinstance(topk_xs, torch.cuda.FloatTensor)
-    assert isinstance(topk_ys, torch.cuda.FloatTensor)
+    assert topk_xs.dtype == torch.float32
+    assert topk_ys.dtype == torch.float32
 
     # Select topK examples across channel (classes)
     # [N, C, K] -----> [N, C*K]
@@ -92,7 +92,7 @@ def select_topk(heat_map, K=100):
     topk_scores, topk_inds = torch.topk(topk_scores_all, K)
     topk_clses = (topk_inds / K).float()
 
-    assert isinstance(topk_clses, torch.cuda.FloatTensor)
+    assert topk_clses.dtype == torch.float32
 
     # First expand it as 3 dimension
     topk_inds_all = _gather_feat(topk_inds_all.view(batch, -1, 1), topk_inds).view(batch, K)
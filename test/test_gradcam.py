@@ -15,7 +15,6 @@ import numpy as np
 import datetime
 from config import TYPE_ID_CONVERSION
 from utils.check_point import DetectronCheckpointer
-from model.backbone import build_backbone
 from engine import (
     default_argument_parser,
     default_setup,
@@ -24,7 +23,7 @@ from engine import (
 import re
 from shutil import copyfile
 from utils.kitti_utils import read_label, Calibration
-from model.head.detector_predictor_test import make_predictor
+from model.detector_test import KeypointDetector_v2
 from model.head.detector_infer_test import postprocess
 from utils.nms2d import nms_eara
 from utils.vis3d import draw_projected_box3d, draw_bev_box3d
@@ -487,34 +486,6 @@ def setup(args):
 
     return cfg, test_config
 
-class KeypointDetector_v2(nn.Module):
-    '''
-    Generalized structure for keypoint based object detector.
-    main parts:
-    - backbone
-    - heads
-    '''
-
-    def __init__(self, cfg):
-        super(KeypointDetector_v2, self).__init__()
-        self.backbone = build_backbone(cfg)
-        self.heads = make_predictor(cfg, self.backbone.out_channels)
-
-    def forward(self, images):
-#         img_comp = torch.load("/workspace/UserData/lpc/Mono_0718/Mono_simple_2d/output/add_cone_fall/onnx_infer/img_input.pt")
-#         img_diff = img_comp - images
-        features = self.backbone(images)
-#         feature_comp = torch.load("/workspace/UserData/lpc/Mono_0718/Mono_simple_2d/output/add_cone_fall/onnx_infer/feature.pt")
-#         feature_diff = feature_comp - features
-        
-        output_cls,  output_regs= self.heads(features)
-#         output_cls_cmp = torch.load("/workspace/UserData/lpc/Mono_0718/Mono_simple_2d/output/add_cone_fall/onnx_infer/output_cls.pt")
-#         output_cls_diff = output_cls_cmp -output_cls
-#         output_regs_cmp = torch.load("/workspace/UserData/lpc/Mono_0718/Mono_simple_2d/output/add_cone_fall/onnx_infer/output_regs.pt")
-#         output_regs_diff = output_regs_cmp -output_regs
-#         pdb.set_trace()
-        return output_cls,  output_regs
-
 def get_imgs_path(src_dir):
     imgs_path_list = []
     for (root, dirs, files) in os.walk(src_dir):
@@ -13,7 +13,6 @@ import numpy as np
 import datetime
 from config import TYPE_ID_CONVERSION
 from utils.check_point import DetectronCheckpointer
-from model.backbone import build_backbone
 from engine import (
     default_argument_parser,
     default_setup,
@@ -22,9 +21,10 @@ from engine import (
 import re
 from shutil import copyfile
 from utils.kitti_utils import  read_label,Calibration
-from model.head.detector_predictor_test import make_predictor
+from model.detector_test import KeypointDetector_v2
 from model.head.detector_infer_test_stacker import postprocess
 from utils.nms2d import nms_eara
+from utils.filter_rules import load_filter_rules
 from utils.vis3d import draw_projected_box3d, draw_bev_box3d
 from utils.visualize_infer import show_result_keypoints,corner_to_3dboundingbox 
 import argparse
@@ -485,34 +485,6 @@ def setup(args):
 
     return cfg, test_config
 
-class KeypointDetector_v2(nn.Module):
-    '''
-    Generalized structure for keypoint based object detector.
-    main parts:
-    - backbone
-    - heads
-    '''
-
-    def __init__(self, cfg):
-        super(KeypointDetector_v2, self).__init__()
-        self.backbone = build_backbone(cfg)
-        self.heads = make_predictor(cfg, self.backbone.out_channels)
-
-    def forward(self, images):
-#         img_comp = torch.load("/workspace/UserData/lpc/Mono_0718/Mono_simple_2d/output/add_cone_fall/onnx_infer/img_input.pt")
-#         img_diff = img_comp - images
-        features = self.backbone(images)
-#         feature_comp = torch.load("/workspace/UserData/lpc/Mono_0718/Mono_simple_2d/output/add_cone_fall/onnx_infer/feature.pt")
-#         feature_diff = feature_comp - features
-        
-        output_cls,  output_regs= self.heads(features)
-#         output_cls_cmp = torch.load("/workspace/UserData/lpc/Mono_0718/Mono_simple_2d/output/add_cone_fall/onnx_infer/output_cls.pt")
-#         output_cls_diff = output_cls_cmp -output_cls
-#         output_regs_cmp = torch.load("/workspace/UserData/lpc/Mono_0718/Mono_simple_2d/output/add_cone_fall/onnx_infer/output_regs.pt")
-#         output_regs_diff = output_regs_cmp -output_regs
-#         pdb.set_trace()
-        return output_cls,  output_regs
-
 def get_imgs_path(src_dir):
     imgs_path_list = []
     for (root, dirs, files) in os.walk(src_dir):
@@ -730,6 +702,7 @@ if __name__ == "__main__":
     img_width, img_height = args.image_size[0], args.image_size[1] # 图片原始尺寸
     trunc_alpha = 0.3
     det_thres = 0.29
+    filter_rules_file = None # 筛选规则yaml路径, None为默认规则(runs/filter_rules.yaml)
     vis_25d =True
     vis_3d =False
     vis_video = True
@@ -758,6 +731,7 @@ if __name__ == "__main__":
     checkpointer = DetectronCheckpointer(cfg, model, save_dir=cfg.OUTPUT_DIR)
     _ = checkpointer.load(args.ckpt, use_latest=False)
     model.eval()
+    filter_rules = load_filter_rules(filter_rules_file, TYPE_ID_CONVERSION)
     postproc = postprocess(input_width,input_height, det_thres).cuda()
 
     ID_TYPE_CONVERSION = {k : v for v, k in TYPE_ID_CONVERSION.items()}
@@ -897,11 +871,10 @@ if __name__ == "__main__":
                 img_3d = draw_2d(img_3d, roi_box)
             
             ## 生成要保留的object
-            objs_extra = [Object3d() for _ in np.arange(box2d_ori.shape[0])]
+            save_mask, truncation = filter_rules(box2d_ori, scores, clses, crop_box, keep, trunc_alpha)
             save_obj = []
-            for k,obj in enumerate(objs_extra):
-                if k not in keep:
-                    continue
+            for k in np.flatnonzero(save_mask):
+                obj = Object3d()
                 obj.t = locations[k]
                 obj.w = dimensions[k][1]
                 obj.l = dimensions[k][2]
@@ -916,42 +889,7 @@ if __name__ == "__main__":
                 obj.keypoint_down= np.array([[kp[0],kp[1]] if vis else [-1,-1]for kp,vis in zip(keypoint[k],keypoint_visible[k])])
                 obj.alpha = scores[k][0]
                 obj.center_type = center_type[k]
-                margin = 75 ## 判定truncation的margin
-                obj.truncation = obj.xmax >crop_box[2] - margin or obj.xmin < crop_box[0]
-                
-                
-                # PD Rider 阈值不同
-                if not obj.truncation:
-                    if obj.type == "PD" or obj.type == "Rider":
-                        alpha_thres = 0.28
-                    else:
-                        alpha_thres = trunc_alpha
-                    # print(obj.type, obj.alpha, obj.truncation)
-                    if obj.alpha < alpha_thres:
-                        # print("OMIT", obj.type, obj.alpha, obj.truncation)
-                        continue
-                    
-                # if obj.l >20 or obj.t[2]>160:
-                #     continue
-                
-                # 2.2 根据长宽比筛选CAR TRUCK
-                if obj.type == ["TRUCK", "trailerback"]:
-                    length_x = abs(obj.xmax-obj.xmin)
-                    length_y = abs(obj.ymax-obj.ymin)
-                    if length_y / length_x > 4.0:
-                        continue
-                if obj.type in ["CAR", "VAN", "SPECIALCAR", "Three"]:
-                    length_x = abs(obj.xmax-obj.xmin)
-                    length_y = abs(obj.ymax-obj.ymin)
-                    if length_y / length_x > 3.0:
-                        continue
-                
-                # box大小筛选
-                if obj.type in ["CAR","Three","BUS","TRUCK","trailerback","VAN"] and (obj.ymax-obj.ymin)*(obj.xmax-obj.xmin)<50:
-                    continue
-                if obj.type in ["PD","Rider"] and (obj.xmax-obj.xmin)<10:
-                    continue
-                
+                obj.truncation = truncation[k]
                 save_obj.append(obj) 
                 
                 ## Visualization
@@ -0,0 +1,78 @@
+"""
+Self-contained inference artifact of the detector (--export_artifact and
+--artifact of test/test.py).
+
+The backbone and heads are traced with TorchScript, exported with
+torch.export when the path ends with .pt2, or to ONNX when it ends with .onnx
+(see utils/backends.py, run by ONNX Runtime), and saved in one file together
+with the json metadata the test pipeline needs: input size, crop and image
+size of the dataset profile, threshold, class names, pixel mean / std and the
+dim_mean / dim_std priors of postprocess. Loading it only takes torch: no
+yaml config, no training checkpoint with its optimizer / scheduler state, no
+key alignment of align_and_update_state_dicts.
+"""
+
+import datetime
+import itertools
+import json
+
+import torch
+
+from utils.backends import OnnxRunner, export_onnx, is_onnx
+
+ARTIFACT_VERSION = 1
+META_FILE = "meta.json"
+
+
+def is_exported_program(path):
+    return path.endswith(".pt2")
+
+
+def export_artifact(model, path, meta):
+    """
+        model: KeypointDetector_v2 in eval mode
+        meta: json serializable dict, with input_size [w, h] at least
+        return: meta as saved
+    """
+    input_width, input_height = meta["input_size"]
+    # the packed weights of a quantized model are no parameters
+    device = next(itertools.chain(model.parameters(), model.buffers()), torch.zeros(0)).device
+    meta = dict(meta, version=ARTIFACT_VERSION, torch=torch.__version__,
+                date=datetime.datetime.now().isoformat(timespec="seconds"))
+    extra_files = {META_FILE: json.dumps(meta)}
+    # batch of 2, so that the batch dimension is not specialized to 1
+    example = torch.zeros((2, 3, input_height, input_width), device=device)
+    with torch.no_grad():
+        if is_onnx(path):
+            export_onnx(model, path, example, extra_files)
+        elif is_exported_program(path):
+            batch = torch.export.Dim("batch", min=1, max=256)
+            program = torch.export.export(model, (example,), dynamic_shapes={"images": {0: batch}})
+            torch.export.save(program, path, extra_files=extra_files)
+        else:
+            traced = torch.jit.trace(model, example)
+            torch.jit.save(traced, path, _extra_files=extra_files)
+    return meta
+
+
+def load_artifact(path, device="cpu", num_threads=0):
+    """
+        device: ignored by ONNX artifacts, they run on the cpu
+        num_threads: intra-op threads of ONNX Runtime, 0 for its default
+        return: callable model (images -> output_cls, output_regs), metadata dict
+    """
+    extra_files = {META_FILE: ""}
+    if is_onnx(path):
+        model = OnnxRunner(path, num_threads)
+        extra_files[META_FILE] = model.metadata[META_FILE]
+    elif is_exported_program(path):
+        program = torch.export.load(path, extra_files=extra_files)
+        model = program.module().to(device)
+    else:
+        model = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+        model.eval()
+    meta = json.loads(extra_files[META_FILE])
+    if meta.get("version", 0) > ARTIFACT_VERSION:
+        raise ValueError("artifact {} has version {}, this code reads up to {}".format(
+            path, meta["version"], ARTIFACT_VERSION))
+    return model, meta
@@ -0,0 +1,106 @@
+"""
+Back-projection of the detections of a batch to the original images, and
+their copy to the host.
+
+All 2d boxes, keypoints and projected centers of a batch are mapped with one
+homogeneous matmul on the inference device, then every output of the batch is
+copied to the host in a single transfer.
+"""
+
+import numpy as np
+import torch
+
+# indexes in the per-image outputs of postprocess
+BOX2D, KEYPOINT, CENTER = 3, 7, 9
+
+
+def back_project_points(points, trans_affine_inv, image_size):
+    """
+        points: P x 2 tensor in model input coordinates
+        trans_affine_inv: 3 x 3, or P x 3 x 3 with the transform of each point
+        image_size: (w, h), or P x 2 with the image size of each point
+        return: P x 2 float64 on the original image, clipped to [0, w - 1] x [0, h - 1]
+    """
+    points = points.to(torch.float64)
+    trans = torch.as_tensor(trans_affine_inv, dtype=torch.float64, device=points.device)
+    homogeneous = torch.cat((points, torch.ones_like(points[:, :1])), dim=1)
+    if trans.dim() == 2:
+        projected = homogeneous @ trans[:2].T
+    else:
+        projected = torch.bmm(trans[:, :2], homogeneous.unsqueeze(2)).squeeze(2)
+    upper = torch.as_tensor(image_size, dtype=torch.float64, device=points.device) - 1
+    return torch.min(projected.clamp(min=0), upper)
+
+
+def back_project_results(results, trans_affine_invs, image_sizes):
+    """
+        Map box2d, keypoints and projected centers of every image of a batch to
+        their original image.
+        results: per-image outputs of postprocess
+        trans_affine_invs: per-image 3 x 3 model input -> original image
+        image_sizes: per-image (w, h)
+        return: results with these three outputs replaced
+    """
+    image_ids = [i for i, result in enumerate(results) if result[0] is not None]
+    if len(image_ids) == 0:
+        return results
+
+    points, counts = [], []
+    for i in image_ids:
+        result = results[i]
+        image_points = torch.cat((result[BOX2D].reshape(-1, 2), result[KEYPOINT].reshape(-1, 2), result[CENTER].reshape(-1, 2)), dim=0)
+        points.append(image_points)
+        counts.append(len(image_points))
+    points = torch.cat(points, dim=0)
+    device = points.device
+
+    first_trans = trans_affine_invs[image_ids[0]]
+    first_size = tuple(image_sizes[image_ids[0]])
+    if all(np.array_equal(trans_affine_invs[i], first_trans) and tuple(image_sizes[i]) == first_size for i in image_ids):
+        # the usual case, every image of the run has the same crop
+        projected = back_project_points(points, first_trans, first_size)
+    else:
+        trans = torch.as_tensor(np.stack([trans_affine_invs[i] for i in image_ids]), dtype=torch.float64, device=device)
+        sizes = torch.as_tensor([tuple(image_sizes[i]) for i in image_ids], dtype=torch.float64, device=device)
+        point_images = torch.repeat_interleave(torch.arange(len(image_ids), device=device), torch.as_tensor(counts, device=device))
+        projected = back_project_points(points, trans[point_images], sizes[point_images])
+
+    results = list(results)
+    for i, image_points in zip(image_ids, projected.split(counts)):
+        result = list(results[i])
+        num_box_points, num_keypoints = result[BOX2D].numel() // 2, result[KEYPOINT].numel() // 2
+        box2d, keypoint, center = image_points.split([num_box_points, num_keypoints, len(image_points) - num_box_points - num_keypoints])
+        result[BOX2D] = box2d.reshape(result[BOX2D].shape).to(result[BOX2D].dtype)
+        result[KEYPOINT] = keypoint.reshape(result[KEYPOINT].shape).to(result[KEYPOINT].dtype)
+        result[CENTER] = center.reshape(result[CENTER].shape).to(result[CENTER].dtype)
+        results[i] = tuple(result)
+    return results
+
+
+def results_to_host(results):
+    """
+        Per-image outputs of a batch as numpy arrays, copied from the device in
+        one transfer. Every output keeps its shape and dtype.
+    """
+    image_ids = [i for i, result in enumerate(results) if result[0] is not None]
+    if len(image_ids) == 0:
+        return list(results)
+
+    # float64 holds the float32, integer and bool outputs exactly
+    rows = [torch.cat([output.reshape(len(output), -1).to(torch.float64) for output in results[i]], dim=1) for i in image_ids]
+    host = torch.cat(rows, dim=0).cpu().numpy()
+
+    host_results = list(results)
+    start = 0
+    for i, row in zip(image_ids, rows):
+        image_host = host[start:start + len(row)]
+        start += len(row)
+        outputs = []
+        column = 0
+        for output in results[i]:
+            width = output[0].numel() if len(output) > 0 else 0
+            numpy_dtype = torch.empty(0, dtype=output.dtype).numpy().dtype
+            outputs.append(image_host[:, column:column + width].astype(numpy_dtype).reshape(tuple(output.shape)))
+            column += width
+        host_results[i] = tuple(outputs)
+    return host_results
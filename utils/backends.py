@@ -0,0 +1,121 @@
+"""
+Execution backends of the detector (--compare_backends of test/test.py).
+
+Every backend is a callable images -> (output_cls, output_regs) like
+KeypointDetector_v2:
+
+    eager        the nn.Module of a checkpoint
+    torchscript  the traced artifact of utils/artifact.py (.pt)
+    onnx         the model exported with export_onnx (.onnx), batch dimension
+                 dynamic, run by ONNX Runtime on the CPU with OnnxRunner
+
+onnx / onnxruntime are only imported when an ONNX model is exported or
+loaded. compare_backends runs the same batches through several backends,
+checks their outputs against the first one and times them, to pick the
+fastest backend of a host.
+"""
+
+import time
+
+import torch
+
+BACKENDS = ("eager", "torchscript", "onnx")
+INPUT_NAMES = ["images"]
+OUTPUT_NAMES = ["output_cls", "output_regs"]
+ONNX_OPSET = 13
+
+
+def is_onnx(path):
+    return path.endswith(".onnx")
+
+
+def export_onnx(model, path, example, metadata=None, opset=ONNX_OPSET):
+    """
+        model: KeypointDetector_v2 in eval mode
+        example: (n, 3, h, w) images on the device of the model, the batch
+                 dimension stays dynamic
+        metadata: str -> str dict saved in the metadata_props of the model
+    """
+    dynamic_axes = {name: {0: "batch"} for name in INPUT_NAMES + OUTPUT_NAMES}
+    with torch.no_grad():
+        torch.onnx.export(model, (example,), path, input_names=INPUT_NAMES, output_names=OUTPUT_NAMES,
+                          dynamic_axes=dynamic_axes, opset_version=opset)
+    if metadata:
+        import onnx
+        onnx_model = onnx.load(path)
+        onnx.helper.set_model_props(onnx_model, metadata)
+        onnx.save(onnx_model, path)
+
+
+class OnnxRunner(object):
+    '''
+    ONNX Runtime session called like the eager model: images tensor ->
+    output_cls, output_regs as CPU tensors.
+    '''
+
+    def __init__(self, path, num_threads=0):
+        """
+            num_threads: intra-op threads of the session, 0 for the ONNX Runtime default
+        """
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_names = [output.name for output in self.session.get_outputs()]
+        self.metadata = dict(self.session.get_modelmeta().custom_metadata_map)
+
+    def __call__(self, images):
+        outputs = self.session.run(self.output_names, {self.input_name: images.detach().cpu().contiguous().numpy()})
+        return tuple(torch.from_numpy(output) for output in outputs)
+
+    def eval(self):
+        return self
+
+
+def compare_backends(models, batches, atol=1e-3, rtol=1e-3, warmup=1):
+    """
+        Run every batch through every backend.
+        models: list of (name, callable, device), the first one is the reference
+        batches: list of (n, 3, h, w) image tensors
+        warmup: batches not timed
+        return: dict name -> {'matched', 'max_diffs' of output_cls / output_regs,
+                'ms_per_image' of the timed batches}
+    """
+    report = {}
+    reference_outputs = None
+    for name, model, device in models:
+        device = torch.device(device)
+        outputs = []
+        elapsed, num_images = 0.0, 0
+        with torch.no_grad():
+            for idx, images in enumerate(batches):
+                images = images.to(device)
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                start = time.perf_counter()
+                output = model(images)
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                if idx >= warmup:
+                    elapsed += time.perf_counter() - start
+                    num_images += images.shape[0]
+                outputs.append([out.contiguous().float().cpu() for out in output])
+        if reference_outputs is None:
+            reference_outputs = outputs
+        max_diffs = [0.0] * len(OUTPUT_NAMES)
+        matched = True
+        for expected, actual in zip(reference_outputs, outputs):
+            for idx, (expected_out, actual_out) in enumerate(zip(expected, actual)):
+                max_diffs[idx] = max(max_diffs[idx], float((actual_out - expected_out).abs().max()))
+                matched = matched and torch.allclose(actual_out, expected_out, rtol=rtol, atol=atol)
+        report[name] = {
+            'device': str(device),
+            'matched': matched,
+            'max_diffs': dict(zip(OUTPUT_NAMES, max_diffs)),
+            'ms_per_image': 1000.0 * elapsed / num_images if num_images > 0 else None,
+        }
+    return report
@@ -0,0 +1,131 @@
+"""
+Per-stage latency benchmark of the test driver (--benchmark).
+
+Every stage of an image goes through Benchmark.stage, from decode to the
+written visualization. Device stages synchronize before and after, so that
+the asynchronous CUDA work lands in the stage that launched it. The first
+`warmup` calls of every stage are not recorded. The report gives p50 / p95 /
+p99 latencies per call and items / s per stage, plus the end to end images / s
+after the warm-up, and is saved as json to compare model and code versions.
+"""
+
+import contextlib
+import datetime
+import json
+import platform
+import threading
+import time
+
+import numpy as np
+import torch
+
+# in the order of the pipeline
+BENCHMARK_STAGES = ("decode", "preprocess", "h2d", "backbone", "heads", "postprocess", "to_host",
+                    "nms", "filter", "write", "render")
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class Benchmark(object):
+    def __init__(self, enabled=False, device=None, warmup=10):
+        """
+            device: torch device of the model, cuda stages are synchronized
+            warmup: calls of every stage not recorded
+        """
+        self.enabled = enabled
+        self.sync = enabled and device is not None and torch.device(device).type == "cuda"
+        self.device = device
+        self.warmup = warmup
+        self.times = {}
+        self.items = {}
+        self.calls = {}
+        self.images = 0
+        self.start_time = None
+        self.end_time = None
+        self._lock = threading.Lock()
+
+    def stage(self, name, items=1, sync=False):
+        """ Context timing one call of a stage on `items` images, a no-op when disabled. """
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._timed(name, items, sync and self.sync)
+
+    @contextlib.contextmanager
+    def _timed(self, name, items, sync):
+        if sync:
+            torch.cuda.synchronize(self.device)
+        start_time = time.perf_counter()
+        yield
+        if sync:
+            torch.cuda.synchronize(self.device)
+        self.add(name, time.perf_counter() - start_time, items)
+
+    def add(self, name, time_diff, items=1):
+        with self._lock:
+            calls = self.calls.get(name, 0)
+            self.calls[name] = calls + 1
+            if calls < self.warmup:
+                return
+            self.times.setdefault(name, []).append(time_diff)
+            self.items[name] = self.items.get(name, 0) + items
+
+    def count_images(self, num, warm):
+        """ End to end count, the clock starts with the first batch after the warm-up. """
+        if not self.enabled or not warm:
+            return
+        now = time.perf_counter()
+        with self._lock:
+            if self.start_time is None:
+                # this batch started the measured window
+                self.start_time = now
+                return
+            self.images += num
+            self.end_time = now
+
+    def report(self, meta=None):
+        stages = {}
+        names = [name for name in BENCHMARK_STAGES if name in self.times]
+        names += sorted(name for name in self.times if name not in BENCHMARK_STAGES)
+        for name in names:
+            times_ms = np.array(self.times[name]) * 1000.0
+            total = times_ms.sum() / 1000.0
+            stages[name] = {
+                "calls": len(times_ms),
+                "items": self.items[name],
+                "mean_ms": float(times_ms.mean()),
+                "p50_ms": float(np.percentile(times_ms, 50)),
+                "p95_ms": float(np.percentile(times_ms, 95)),
+                "p99_ms": float(np.percentile(times_ms, 99)),
+                "max_ms": float(times_ms.max()),
+                "items_per_sec": self.items[name] / total if total > 0 else 0.0,
+            }
+        wall_time = self.end_time - self.start_time if self.end_time is not None else 0.0
+        return {
+            "meta": dict(meta or {}, date=datetime.datetime.now().isoformat(timespec="seconds"),
+                         host=platform.node(), torch=torch.__version__, synchronized=self.sync,
+                         warmup=self.warmup),
+            "images": self.images,
+            "wall_time": wall_time,
+            "images_per_sec": self.images / wall_time if wall_time > 0 else 0.0,
+            "stages": stages,
+        }
+
+    def save(self, path, meta=None):
+        report = self.report(meta)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        return report
+
+
+def print_benchmark(report):
+    print()
+    print("[BENCHMARK]")
+    print(" {:<12} {:>7} {:>7} {:>9} {:>9} {:>9} {:>9} {:>10}".format(
+        "stage", "calls", "items", "mean_ms", "p50_ms", "p95_ms", "p99_ms", "items/s"))
+    for name, stats in report["stages"].items():
+        print(" {:<12} {:>7d} {:>7d} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>10.1f}".format(
+            name, stats["calls"], stats["items"], stats["mean_ms"], stats["p50_ms"],
+            stats["p95_ms"], stats["p99_ms"], stats["items_per_sec"]))
+    print(" {:<12}: {} images in {:.2f}s, {:.1f} img/s".format(
+        "end_to_end", report["images"], report["wall_time"], report["images_per_sec"]))
+    print()
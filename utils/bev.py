@@ -0,0 +1,79 @@
+"""
+Bird's eye view maps of the test and eval visualizations.
+
+The polar range circles and grid lines only depend on the map size and the
+world size, so the grid is drawn once per (out_size, world_size) and copied
+for every frame. The footprints of all the boxes of a frame are projected to
+the map at once, and drawn with one cv2.polylines call per color (plus one for
+the heading edges, which are thicker).
+"""
+
+import functools
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+@functools.lru_cache(maxsize=8)
+def bev_template(out_size=800, world_size=160, polar_step_size_meters=10):
+    """ Empty BEV map with its metric polar grid, read only. """
+    pixels_per_meter = out_size // world_size # 每米5个pixel
+    center_pixel = (out_size // 2, out_size)
+    img_bev = np.full((out_size, out_size, 3), 230, dtype=np.uint8)
+    for i in range(1, int(out_size / (polar_step_size_meters * pixels_per_meter))):
+        radius = int(i * polar_step_size_meters * pixels_per_meter)
+        cv2.circle(img_bev, center_pixel, radius, (50, 50, 50), 2)
+        cv2.line(img_bev, (0, center_pixel[1] - radius), (out_size, center_pixel[1] - radius), (200, 200, 200))
+        cv2.line(img_bev, (abs(radius), 0), (abs(radius), out_size), (200, 200, 200))
+    img_bev.setflags(write=False)
+    return img_bev
+
+
+def new_bev_map(out_size=800, world_size=160, out=None):
+    """ Copy of the BEV template to draw a frame on, into out if given. """
+    template = bev_template(out_size, world_size)
+    if out is None:
+        return template.copy()
+    np.copyto(out, template)
+    return out
+
+
+def bev_points(corners3d, world_size=160, out_size=800):
+    """
+        corners3d: N x 8 x 3 box corners in camera coordinates, the first 4 on the bottom face
+        return: N x 4 x 2 int32 footprints on the BEV map
+    """
+    pts = np.asarray(corners3d, dtype=np.float64).reshape(-1, 8, 3)[:, :4][:, :, [0, 2]]
+    pts[:, :, 0] += world_size / 2
+    pts[:, :, 1] = world_size - pts[:, :, 1]
+    return (pts * out_size / world_size).astype(np.int32)
+
+
+def draw_bev_boxes(image, corners3d, colors, ids=None, world_size=160, out_size=800, thickness=2, heading_thickness=4):
+    """
+        Same drawing as draw_bev_box3d, for all boxes of a frame.
+        corners3d: N x 8 x 3
+        colors: N colors, or one for all boxes
+        ids: N ids drawn next to the boxes, 0 for none
+    """
+    if len(corners3d) == 0:
+        return image
+    pts = bev_points(corners3d, world_size, out_size)
+    if len(colors) != len(pts) or np.ndim(colors[0]) == 0:
+        colors = [tuple(colors)] * len(pts)
+
+    groups = OrderedDict()
+    for idx, color in enumerate(colors):
+        groups.setdefault(tuple(color), []).append(idx)
+    for color, idxs in groups.items():
+        cv2.polylines(image, list(pts[idxs].reshape(-1, 4, 1, 2)), True, color, thickness, lineType=cv2.LINE_AA)
+        cv2.polylines(image, list(pts[idxs][:, :2].reshape(-1, 2, 1, 2)), False, color, heading_thickness, lineType=cv2.LINE_AA)
+
+    if ids is not None:
+        origin = (out_size // 2, out_size)
+        for idx in np.flatnonzero(np.asarray(ids) != 0):
+            pt = (int(pts[idx, 1, 0]), int(pts[idx, 1, 1]))
+            if pt != origin:
+                cv2.putText(image, str(ids[idx]), pt, cv2.FONT_HERSHEY_SIMPLEX, 1, tuple(colors[idx]), 1, lineType=cv2.LINE_AA)
+    return image
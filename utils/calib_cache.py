@@ -0,0 +1,112 @@
+"""
+Cache of parsed calibration files.
+
+Building a Calibration from an xml annotation parses the whole file with lxml,
+while most frames share the intrinsics of a handful of cameras. Parsed
+calibrations are cached by path + mtime, and optionally by the content of the
+<Lidar2CamParam> block, so frames of the same camera are parsed only once.
+Callers always get a copy: matAndUpdate / normalize_calib modify P in place.
+"""
+
+import copy
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from utils.kitti_utils import Calibration
+
+_CAMERA_PARAM_PATTERN = re.compile(rb"<Lidar2CamParam>.*?</Lidar2CamParam>", re.S)
+
+
+class CalibrationCache(object):
+    def __init__(self, max_size=4096, dedup_content=False):
+        self.max_size = max_size
+        self.dedup_content = dedup_content
+        self.hits = 0
+        self.misses = 0
+        self._by_path = OrderedDict()
+        self._by_content = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, calib_filepath, calib_cls=Calibration):
+        """
+            Equivalent of calib_cls(calib_filepath), raises the same way if the file
+            can not be read.
+        """
+        stat = os.stat(calib_filepath)
+        path_key = (calib_cls, os.path.abspath(calib_filepath), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            calib = self._lookup(self._by_path, path_key)
+        if calib is not None:
+            return copy_calibration(calib)
+
+        content_key = None
+        if self.dedup_content:
+            content_key = (calib_cls, self._content_digest(calib_filepath))
+            with self._lock:
+                calib = self._lookup(self._by_content, content_key)
+
+        if calib is None:
+            calib = calib_cls(calib_filepath)
+            with self._lock:
+                self.misses += 1
+                if content_key is not None:
+                    self._insert(self._by_content, content_key, calib)
+        with self._lock:
+            self._insert(self._by_path, path_key, calib)
+        return copy_calibration(calib)
+
+    def clear(self):
+        with self._lock:
+            self._by_path.clear()
+            self._by_content.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def _lookup(self, table, key):
+        calib = table.get(key)
+        if calib is not None:
+            table.move_to_end(key)
+            self.hits += 1
+        return calib
+
+    def _insert(self, table, key, calib):
+        table[key] = calib
+        table.move_to_end(key)
+        while len(table) > self.max_size:
+            table.popitem(last=False)
+
+    @staticmethod
+    def _content_digest(calib_filepath):
+        # only the camera parameters matter, annotations differ per frame
+        with open(calib_filepath, "rb") as f:
+            data = f.read()
+        match = _CAMERA_PARAM_PATTERN.search(data)
+        if match is not None:
+            data = match.group(0)
+        return hashlib.sha1(data).hexdigest()
+
+
+def copy_calibration(calib):
+    """ Shallow copy of a Calibration with its own matrices. """
+    new_calib = copy.copy(calib)
+    for key, value in vars(calib).items():
+        if isinstance(value, np.ndarray):
+            setattr(new_calib, key, value.copy())
+    return new_calib
+
+
+_CALIB_CACHE = CalibrationCache()
+
+
+def get_calib_cache():
+    return _CALIB_CACHE
+
+
+def load_calibration(calib_filepath, calib_cls=Calibration):
+    """ Cached calib_cls(calib_filepath) through the process-wide cache. """
+    return _CALIB_CACHE.get(calib_filepath, calib_cls)
@@ -0,0 +1,95 @@
+"""
+Output canvases of the test and eval visualizations.
+
+The overlays used to be drawn on the original image (3840x2160, 2880x1860,
+...), which was then resized to the output size. A Canvas in scale_first mode
+resizes the image first, into a buffer reused from frame to frame, and the
+callers scale points, line widths and font sizes to the output before
+drawing. Without scale_first it draws on a copy of the original image and
+resizes at the end, as before.
+"""
+
+import threading
+
+import cv2
+import numpy as np
+
+VIS_CANVAS_MODES = ("full", "scaled")
+
+_local = threading.local()
+
+
+class Canvas(object):
+    def __init__(self, output_size, scale_first=True):
+        """
+            output_size: (w, h) of the visualization
+            scale_first: resize the image before drawing
+        """
+        self.output_size = (int(output_size[0]), int(output_size[1]))
+        self.scale_first = scale_first
+        self.buffer = np.empty((self.output_size[1], self.output_size[0], 3), dtype=np.uint8)
+        self.scale_xy = np.ones(2)
+        self.image = None
+
+    def begin(self, img, code=None):
+        """
+            Start a frame of img, code: optional cv2 color conversion.
+            return: image to draw on, in scale_first mode the canvas buffer
+        """
+        if self.scale_first:
+            h, w = img.shape[:2]
+            self.scale_xy = np.array([self.output_size[0] / w, self.output_size[1] / h])
+            cv2.resize(img, self.output_size, dst=self.buffer)
+            if code is not None:
+                cv2.cvtColor(self.buffer, code, dst=self.buffer)
+            self.image = self.buffer
+        else:
+            self.scale_xy = np.ones(2)
+            self.image = cv2.cvtColor(img, code) if code is not None else img.copy()
+        return self.image
+
+    def finish(self):
+        """ The frame in the output size, valid until the next begin. """
+        if not self.scale_first:
+            cv2.resize(self.image, self.output_size, dst=self.buffer)
+        self.image = None
+        return self.buffer
+
+    @property
+    def scale(self):
+        # line widths, radii and fonts follow the vertical scale
+        return float(self.scale_xy[1])
+
+    def points(self, pts):
+        """ N x 2 points of the original image on the canvas, float. """
+        return np.asarray(pts, dtype=np.float64).reshape(-1, 2) * self.scale_xy
+
+    def point(self, pt):
+        x, y = self.points(pt)[0]
+        return (int(x), int(y))
+
+    def box(self, box2d):
+        """ [xmin, ymin, xmax, ymax] on the canvas. """
+        return self.points(box2d).reshape(-1)
+
+    def thickness(self, thickness):
+        if not self.scale_first:
+            return thickness
+        return max(1, int(round(thickness * self.scale)))
+
+    def font_scale(self, font_scale):
+        return font_scale * self.scale if self.scale_first else font_scale
+
+
+def get_canvas(stream, output_size, scale_first=True):
+    """
+        Canvas of a visualization stream ("25D", "3D", ...), one per thread so
+        that render workers never share a buffer.
+    """
+    canvases = getattr(_local, "canvases", None)
+    if canvases is None:
+        canvases = _local.canvases = {}
+    canvas = canvases.get(stream)
+    if canvas is None or canvas.output_size != tuple(int(v) for v in output_size) or canvas.scale_first != scale_first:
+        canvas = canvases[stream] = Canvas(output_size, scale_first)
+    return canvas
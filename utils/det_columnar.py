@@ -0,0 +1,203 @@
+"""
+Columnar detection output of the test driver.
+
+Instead of one KITTI txt per image, the detections of a run are collected in
+columns and written as compressed npz parts, one series per rank:
+<output_dir>/det_npz/dets.<rank>.<part>.npz, holding
+    images            (S,)      names of the images of the part, also the ones without detections
+    image_index       (N,)      index in images of every detection
+    class_names       (C,)      class id -> name
+    cls               (N,)
+    truncation        (N,)
+    score             (N,)      written as alpha in the KITTI txt
+    box2d             (N, 4)    xmin ymin xmax ymax on the original image
+    dimensions        (N, 3)    h w l
+    location          (N, 3)
+    ry                (N,)
+    keypoints         (N, 4, 2)
+    keypoint_visible  (N, 4)
+Parts are read back with load_det_columnar, which can also emit the txt
+layout of box_to_string2 in test/test.py.
+"""
+
+import argparse
+import glob
+import os
+import threading
+
+import numpy as np
+
+COLUMNS = ("cls", "truncation", "score", "box2d", "dimensions", "location", "ry", "keypoints", "keypoint_visible")
+
+# name truncation occlusion alpha bbox(4) hwl(3) xyz(3) ry cube(16) vislines(4) vid
+KITTI_LINE_FORMAT = "{} {:.2f} {:d} " + "{:.2f} " * 32 + "{:d}"
+
+
+class ColumnarWriter(object):
+    def __init__(self, output_dir, class_names, rank=0, flush_every=1000):
+        """
+            class_names: class id -> name
+            flush_every: number of images per part
+        """
+        self.output_dir = output_dir
+        self.class_names = np.array(class_names)
+        self.rank = rank
+        self.flush_every = flush_every
+        os.makedirs(output_dir, exist_ok=True)
+        # keep the parts of previous (resumed) runs, after the last one even if an earlier one is missing
+        parts = [part for part in glob.glob(os.path.join(output_dir, "dets.{}.*.npz".format(rank))) if not part.endswith(".tmp.npz")]
+        self.part = max([int(os.path.basename(part).split(".")[2]) for part in parts], default=-1) + 1
+        self._images = []
+        self._columns = []
+        self._callbacks = []
+        self._flushed = set()
+        self._lock = threading.Lock()
+
+    def part_path(self, part):
+        return os.path.join(self.output_dir, "dets.{}.{:05d}.npz".format(self.rank, part))
+
+    def add(self, image_name, columns):
+        """
+            Add the detections of one image, columns: dict of the COLUMNS arrays.
+            return: path of the part the image will be written to
+        """
+        with self._lock:
+            part_path = self.part_path(self.part)
+            self._images.append(image_name)
+            self._columns.append(columns)
+            if len(self._images) >= self.flush_every:
+                self._flush()
+        return part_path
+
+    def on_flushed(self, part_path, callback):
+        """ Call `callback` once part_path is written, now if it already is. """
+        with self._lock:
+            if part_path not in self._flushed:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def close(self):
+        with self._lock:
+            if len(self._images) > 0:
+                self._flush()
+
+    def _flush(self):
+        part_path = self.part_path(self.part)
+        counts = [len(columns["cls"]) for columns in self._columns]
+        arrays = {
+            "images": np.array(self._images),
+            "image_index": np.repeat(np.arange(len(counts), dtype=np.int32), counts),
+            "class_names": self.class_names,
+        }
+        for key in COLUMNS:
+            arrays[key] = np.concatenate([np.asarray(columns[key]) for columns in self._columns], axis=0)
+        # write to a temp file first, a killed run never leaves a broken part
+        tmp_path = part_path[:-len(".npz")] + ".tmp.npz"
+        np.savez_compressed(tmp_path, **arrays)
+        os.replace(tmp_path, part_path)
+
+        self._flushed.add(part_path)
+        self.part += 1
+        self._images, self._columns = [], []
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+class ColumnarDetections(object):
+    """ Detections of one or several npz parts, by image name. """
+
+    def __init__(self, parts):
+        self.columns = {key: [] for key in COLUMNS}
+        self.class_names = None
+        self.rows = {}
+        num_rows = 0
+        for part in parts:
+            with np.load(part) as data:
+                if self.class_names is None:
+                    self.class_names = data["class_names"]
+                image_index = data["image_index"]
+                order = np.argsort(image_index, kind="stable")
+                bounds = np.searchsorted(image_index[order], np.arange(len(data["images"]) + 1))
+                for i, image_name in enumerate(data["images"]):
+                    # a later part (resumed run) replaces the detections of an image
+                    self.rows[str(image_name)] = num_rows + order[bounds[i]:bounds[i + 1]]
+                for key in COLUMNS:
+                    self.columns[key].append(data[key])
+                num_rows += len(image_index)
+        for key in COLUMNS:
+            self.columns[key] = np.concatenate(self.columns[key], axis=0) if self.columns[key] else np.zeros(0)
+
+    def __contains__(self, image_name):
+        return image_name in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def image_names(self):
+        return list(self.rows.keys())
+
+    def get(self, image_name):
+        """ dict of the COLUMNS arrays of one image, None if it has no detection output. """
+        rows = self.rows.get(image_name)
+        if rows is None:
+            return None
+        return {key: self.columns[key][rows] for key in COLUMNS}
+
+    def kitti_lines(self, image_name):
+        """ Detections of one image in the txt layout of box_to_string2, None as for a missing txt. """
+        dets = self.get(image_name)
+        if dets is None:
+            return None
+        num = len(dets["cls"])
+        cube = np.full((num, 8, 2), -1.0)
+        cube[:, :4] = np.where(dets["keypoint_visible"][:, :, None], dets["keypoints"], -1)
+        values = np.concatenate([
+            dets["score"].reshape(-1, 1),
+            dets["box2d"].reshape(-1, 4),
+            dets["dimensions"].reshape(-1, 3),
+            dets["location"].reshape(-1, 3),
+            dets["ry"].reshape(-1, 1),
+            cube.reshape(-1, 16),
+            np.full((num, 4), -1.0),
+        ], axis=1).astype(np.float64)
+        names = self.class_names[dets["cls"].astype(np.int64)]
+        truncation = dets["truncation"].astype(np.float64)
+        return [KITTI_LINE_FORMAT.format(names[i], truncation[i], 0, *values[i].tolist(), 0) for i in range(num)]
+
+
+def find_det_parts(det_path):
+    """ npz parts of a det_npz dir, or det_path itself if it is a npz file. """
+    if det_path.endswith(".npz") and os.path.isfile(det_path):
+        return [det_path]
+    parts = glob.glob(os.path.join(det_path, "dets.*.npz"))
+    parts = [part for part in parts if not part.endswith(".tmp.npz")]
+    # oldest first, newer parts replace the images they share
+    return sorted(parts, key=lambda part: (os.path.getmtime(part), part))
+
+
+def load_det_columnar(det_path):
+    parts = find_det_parts(det_path)
+    if len(parts) == 0:
+        raise FileNotFoundError("no columnar detections in {}".format(det_path))
+    return ColumnarDetections(parts)
+
+
+def export_kitti_txt(det_path, output_dir):
+    """ Write the legacy per-image KITTI txt files of columnar detections. """
+    dets = load_det_columnar(det_path)
+    os.makedirs(output_dir, exist_ok=True)
+    for image_name in dets.image_names():
+        txt_name = image_name.replace('jpg', 'txt').replace('png', 'txt')
+        with open(os.path.join(output_dir, txt_name), 'w') as f:
+            f.writelines(line + '\n' for line in dets.kitti_lines(image_name))
+    return len(dets)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export columnar detections to KITTI txt")
+    parser.add_argument("--input", type=str, required=True, help="det_npz dir or one npz part")
+    parser.add_argument("--output", type=str, required=True, help="dir of the txt files")
+    args = parser.parse_args()
+    print("exported {} images".format(export_kitti_txt(args.input, args.output)))
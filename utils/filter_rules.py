@@ -0,0 +1,112 @@
+"""
+Per-class rules filtering the detections of the test scripts after nms.
+
+A rule table gives, per class name:
+    min_score:  score threshold, not applied to truncated objects
+                (None: the --alpha of the test script)
+    max_aspect: max box height / width
+    min_area:   min box area in pixels of the original image
+    min_width:  min box width in pixels of the original image
+plus the truncation margin to the right border of the crop box. Tables can be
+loaded from yaml, see runs/filter_rules.yaml. All rules are evaluated as masks
+over every detection at once.
+"""
+
+import copy
+
+import numpy as np
+import yaml
+
+RULE_KEYS = ("min_score", "max_aspect", "min_area", "min_width")
+
+DEFAULT_FILTER_RULES = {
+    "truncation_margin": 75,
+    "default": {"min_score": None},
+    "classes": {
+        # PD Rider 阈值不同
+        "PD": {"min_score": 0.28, "min_width": 10},
+        "Rider": {"min_score": 0.28, "min_width": 10},
+        # 根据长宽比筛选CAR, box大小筛选
+        "CAR": {"max_aspect": 3.0, "min_area": 50},
+        "VAN": {"max_aspect": 3.0, "min_area": 50},
+        "SPECIALCAR": {"max_aspect": 3.0},
+        "Three": {"max_aspect": 3.0, "min_area": 50},
+        "BUS": {"min_area": 50},
+        # the 4.0 aspect limit of TRUCK / trailerback in the former loop compared
+        # the type to a list and never applied, add max_aspect here to enable it
+        "TRUCK": {"min_area": 50},
+        "trailerback": {"min_area": 50},
+    },
+}
+
+
+class FilterRules(object):
+    def __init__(self, rules, type_id_conversion):
+        """
+            rules: rule table, see DEFAULT_FILTER_RULES
+            type_id_conversion: class name -> class id of the model
+        """
+        self.rules = rules
+        self.truncation_margin = rules.get("truncation_margin", 75)
+        unknown = set(rules.get("classes", {})) - set(type_id_conversion)
+        if len(unknown) > 0:
+            raise ValueError("filter rules for unknown classes: {}".format(sorted(unknown)))
+
+        # one value per class id, the fallback of each rule never filters
+        num_classes = max(type_id_conversion.values()) + 1
+        default = rules.get("default", {})
+        fallback = {"min_score": np.nan, "max_aspect": np.inf, "min_area": -np.inf, "min_width": -np.inf}
+        self.tables = {}
+        for key in RULE_KEYS:
+            value = default.get(key)
+            self.tables[key] = np.full(num_classes, fallback[key] if value is None else value, dtype=np.float64)
+        for name, class_rules in rules.get("classes", {}).items():
+            for key, value in class_rules.items():
+                if key not in RULE_KEYS:
+                    raise ValueError("unknown filter rule {} of class {}".format(key, name))
+                self.tables[key][type_id_conversion[name]] = np.nan if value is None else value
+
+    @classmethod
+    def from_yaml(cls, rules_file, type_id_conversion):
+        with open(rules_file) as f:
+            rules = yaml.safe_load(f)
+        return cls(rules, type_id_conversion)
+
+    def __call__(self, boxes, scores, clses, crop_box, keep=None, min_score=0.0):
+        """
+            boxes: N x 4 [xmin, ymin, xmax, ymax] on the original image
+            scores, clses: N
+            keep: indexes kept by nms, all if None
+            min_score: score threshold of classes without their own
+            return: mask of the detections to save, truncation flags
+        """
+        boxes = np.asarray(boxes)
+        scores = np.asarray(scores).reshape(-1)
+        clses = np.asarray(clses).reshape(-1).astype(np.int64)
+        if keep is None:
+            mask = np.ones(len(scores), dtype=bool)
+        else:
+            mask = np.zeros(len(scores), dtype=bool)
+            mask[np.asarray(keep, dtype=np.int64)] = True
+
+        xmin, ymin, xmax, ymax = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+        truncation = (xmax > crop_box[2] - self.truncation_margin) | (xmin < crop_box[0])
+
+        # thresholds in the precision of the detections, as python scalars compare with them
+        class_min_score = self.tables["min_score"][clses]
+        class_min_score = np.where(np.isnan(class_min_score), min_score, class_min_score).astype(scores.dtype)
+        mask &= truncation | ~(scores < class_min_score)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            aspect = np.abs(ymax - ymin) / np.abs(xmax - xmin)
+        mask &= ~(aspect > self.tables["max_aspect"][clses].astype(aspect.dtype))
+        mask &= ~((ymax - ymin) * (xmax - xmin) < self.tables["min_area"][clses].astype(boxes.dtype))
+        mask &= ~((xmax - xmin) < self.tables["min_width"][clses].astype(boxes.dtype))
+        return mask, truncation
+
+
+def load_filter_rules(rules_file, type_id_conversion):
+    """ FilterRules of a yaml file, or the default table if rules_file is None. """
+    if rules_file is None:
+        return FilterRules(copy.deepcopy(DEFAULT_FILTER_RULES), type_id_conversion)
+    return FilterRules.from_yaml(rules_file, type_id_conversion)
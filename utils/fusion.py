@@ -0,0 +1,63 @@
+"""
+Inference-only rewrites of the detector (--fuse_bn and --channels_last of
+test/test.py).
+
+fuse_conv_bn folds every BatchNorm2d of an nn.Sequential into the Conv2d or
+ConvTranspose2d right before it and leaves an nn.Identity in its place, so
+that the indices used by the forward passes (class_head[:-1]) still hold.
+All the Conv -> BN -> ReLU blocks of Vggx2SmallNet, Vggx2SmallDeconvFPN and of
+the predictor heads are of that form. to_channels_last stores the weights as
+NHWC, the layout cuDNN and oneDNN run their convolutions in without
+transposes, the inputs have to be channels last as well. check_parity
+compares the outputs of the rewritten model with the ones of the original.
+"""
+
+import torch
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+
+def fuse_conv_bn(model):
+    """
+        Fold the BatchNorm2d of every Conv -> BN pair in place, eval mode only.
+        return: number of folded BatchNorm2d
+    """
+    if model.training:
+        raise ValueError("BatchNorm can only be folded in eval mode")
+    num_fused = 0
+    for module in list(model.modules()):
+        if not isinstance(module, nn.Sequential):
+            continue
+        for idx in range(len(module) - 1):
+            conv, bn = module[idx], module[idx + 1]
+            if not isinstance(conv, (nn.Conv2d, nn.ConvTranspose2d)) or not isinstance(bn, nn.BatchNorm2d):
+                continue
+            if not bn.track_running_stats:
+                # normalized with the batch statistics, nothing to fold
+                continue
+            module[idx] = fuse_conv_bn_eval(conv, bn, transpose=isinstance(conv, nn.ConvTranspose2d))
+            module[idx + 1] = nn.Identity()
+            num_fused += 1
+    return num_fused
+
+
+def to_channels_last(model):
+    return model.to(memory_format=torch.channels_last)
+
+
+def check_parity(reference, model, inputs, atol=1e-3, rtol=1e-3, channels_last=False):
+    """
+        Run both models on inputs.
+        return: whether all outputs match within atol + rtol * |reference|,
+                max abs difference of every output
+    """
+    with torch.no_grad():
+        expected = reference(inputs)
+        actual = model(inputs.contiguous(memory_format=torch.channels_last) if channels_last else inputs)
+    matched = True
+    max_diffs = []
+    for expected_out, actual_out in zip(expected, actual):
+        actual_out = actual_out.contiguous()
+        max_diffs.append(float((actual_out - expected_out).abs().max()))
+        matched = matched and torch.allclose(actual_out, expected_out, rtol=rtol, atol=atol)
+    return matched, max_diffs
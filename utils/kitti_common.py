@@ -291,6 +291,12 @@ def add_difficulty_to_annos(info):
 
 
 def get_label_anno(label_path):
+    with open(label_path, 'r') as f:
+        lines = f.readlines()
+    return get_label_anno_from_lines(lines)
+
+def get_label_anno_from_lines(lines):
+    """ get_label_anno of the lines of a label file. """
     annotations = {}
     annotations.update({
         'name': [],
@@ -302,8 +308,6 @@ def get_label_anno(label_path):
         'location': [],
         'rotation_y': []
     })
-    with open(label_path, 'r') as f:
-        lines = f.readlines()
     # if len(lines) == 0 or len(lines[0]) < 15:
     #     content = []
     # else:
@@ -0,0 +1,175 @@
+"""
+Bounded multi-stage pipeline used by the test driver.
+Each stage is a pool of worker threads reading from a bounded queue, so that
+image decoding and result writing overlap with the model forward pass.
+"""
+
+import queue
+import threading
+import time
+
+_STOP = object()
+
+
+class _Failure(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class StageStats(object):
+    """ Busy time and queue depth bookkeeping of one stage. """
+
+    def __init__(self, name, num_workers=1):
+        self.name = name
+        self.num_workers = num_workers
+        self.items = 0
+        self.busy_time = 0.0
+        self.depth_sum = 0
+        self.depth_samples = 0
+        self.max_depth = 0
+        self._lock = threading.Lock()
+
+    def add_busy(self, time_diff, items=1):
+        with self._lock:
+            self.busy_time += time_diff
+            self.items += items
+
+    def sample_depth(self, depth):
+        with self._lock:
+            self.depth_sum += depth
+            self.depth_samples += 1
+            self.max_depth = max(self.max_depth, depth)
+
+    @property
+    def mean_depth(self):
+        return self.depth_sum / self.depth_samples if self.depth_samples > 0 else 0.0
+
+    def utilization(self, wall_time):
+        if wall_time <= 0:
+            return 0.0
+        return self.busy_time / (wall_time * self.num_workers)
+
+
+class Stage(object):
+    """
+        A pool of `num_workers` threads mapping `func` over the items put into a
+        bounded input queue of `queue_size`.
+        Results are pushed to `output` (a queue) as (idx, result) if it is given.
+        Exceptions are forwarded to the output and re-raised by `iter_ordered`.
+    """
+
+    def __init__(self, name, func, num_workers=1, queue_size=8, output=None):
+        self.name = name
+        self.func = func
+        self.num_workers = max(1, num_workers)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.output = output
+        self.stats = StageStats(name, self.num_workers)
+        self.errors = []
+        self._threads = []
+
+    def start(self):
+        for i in range(self.num_workers):
+            t = threading.Thread(target=self._work, name="{}-{}".format(self.name, i), daemon=True)
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def put(self, idx, item, block=True):
+        """ Returns False if the queue is full and block is False. """
+        self.stats.sample_depth(self.queue.qsize())
+        try:
+            self.queue.put((idx, item), block=block)
+        except queue.Full:
+            return False
+        return True
+
+    def close(self, wait=True):
+        """ No more items will be put, stop workers once the queue is drained. """
+        for _ in self._threads:
+            self.queue.put(_STOP)
+        if wait:
+            self.join()
+
+    def join(self):
+        for t in self._threads:
+            t.join()
+
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            if task is _STOP:
+                break
+            idx, item = task
+            start_time = time.time()
+            try:
+                result = self.func(item)
+            except Exception as e:
+                self.errors.append((idx, e))
+                result = _Failure(e)
+            self.stats.add_busy(time.time() - start_time)
+            if self.output is not None:
+                self.output.put((idx, result))
+
+
+def feed(stage, items, close=True):
+    """
+        Put all items into a stage from a background thread, return the thread.
+        An exception of the items iterator is forwarded to the output after the
+        items before it, and re-raised there by `iter_ordered`.
+    """
+    def _feed():
+        num_fed = 0
+        try:
+            for idx, item in enumerate(items):
+                stage.put(idx, item)
+                num_fed = idx + 1
+        except Exception as e:
+            stage.errors.append((num_fed, e))
+            if stage.output is not None:
+                stage.output.put((num_fed, _Failure(e)))
+        finally:
+            if close:
+                stage.close()
+                # tell iter_ordered that no more results will come
+                if stage.output is not None:
+                    stage.output.put((None, None))
+
+    t = threading.Thread(target=_feed, name="{}-feeder".format(stage.name), daemon=True)
+    t.start()
+    return t
+
+
+def iter_ordered(output, num_items=None):
+    """
+        Yield results of an output queue in submission order.
+        Stops after `num_items` results, or at the first None index if unknown.
+    """
+    pending = {}
+    next_idx = 0
+    while num_items is None or next_idx < num_items:
+        if next_idx in pending:
+            result = pending.pop(next_idx)
+        else:
+            idx, result = output.get()
+            if idx is None:
+                break
+            if idx != next_idx:
+                pending[idx] = result
+                continue
+        if isinstance(result, _Failure):
+            raise result.exc
+        yield result
+        next_idx += 1
+
+
+def print_stage_summary(stats_list, wall_time):
+    print()
+    print("[PIPELINE]")
+    print(" {:<10} {:>8} {:>8} {:>10} {:>10} {:>8}".format("stage", "workers", "items", "mean_q", "max_q", "util"))
+    for stats in stats_list:
+        print(" {:<10} {:>8d} {:>8d} {:>10.2f} {:>10d} {:>7.1f}%".format(
+            stats.name, stats.num_workers, stats.items, stats.mean_depth, stats.max_depth,
+            100.0 * stats.utilization(wall_time)))
+    print(" {:<10}: {:.2f}s".format("wall_time", wall_time))
+    print()
@@ -0,0 +1,125 @@
+"""
+Reduced precision inference (--precision of test/test.py).
+
+The backbone and the predictor run under torch.autocast, bf16 on the CPU and
+fp16 (or bf16) on the GPU, the weights stay fp32. postprocess casts the
+heatmap and the regression values it gathers back to fp32, so that the decode
+steps (inverse sigmoid depth, orientation, image to rect projection) are not
+affected. PrecisionParity compares the detections of a batch with the ones of
+the same batch in fp32 and counts the ones that changed.
+"""
+
+import contextlib
+
+import numpy as np
+import torch
+
+PRECISIONS = ("fp32", "fp16", "bf16")
+AUTOCAST_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
+
+# indexes in the per-image outputs of postprocess
+CLS, BOX2D, LOCATION = 0, 3, 6
+
+
+def check_precision(precision, device):
+    if precision not in PRECISIONS:
+        raise ValueError("unknown precision {}, known: {}".format(precision, PRECISIONS))
+    if precision == "fp16" and torch.device(device).type != "cuda":
+        raise ValueError("fp16 autocast needs cuda, use bf16 on the cpu")
+
+
+def autocast(precision, device):
+    """ autocast context of the precision on the device, a no-op for fp32. """
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    return torch.autocast(torch.device(device).type, dtype=AUTOCAST_DTYPES[precision])
+
+
+def box_iou(boxes_a, boxes_b):
+    """ boxes: N x 4 / M x 4 [x1, y1, x2, y2]. return: N x M """
+    lt = np.maximum(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    rb = np.minimum(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    inter = np.prod(np.clip(rb - lt, 0, None), axis=2)
+    area_a = np.prod(boxes_a[:, 2:] - boxes_a[:, :2], axis=1)
+    area_b = np.prod(boxes_b[:, 2:] - boxes_b[:, :2], axis=1)
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-6)
+
+
+class PrecisionParity(object):
+    '''
+    Detections of the reduced precision model against the fp32 ones, on the
+    host results of the same images. Every fp32 detection is matched to the
+    reduced precision detection of highest 2d IoU (at least match_iou), a
+    matched one changed if its class differs, a corner of its 2d box moved
+    more than box_tol pixels, or its depth more than depth_tol relative.
+    '''
+
+    def __init__(self, box_tol=2.0, depth_tol=0.01, match_iou=0.5):
+        self.box_tol = box_tol
+        self.depth_tol = depth_tol
+        self.match_iou = match_iou
+        self.images = 0
+        self.reference = 0
+        self.detections = 0
+        self.missing = 0
+        self.extra = 0
+        self.class_changed = 0
+        self.box_changed = 0
+        self.depth_changed = 0
+        self.max_box_diff = 0.0
+        self.max_depth_diff = 0.0
+
+    def add(self, reference_results, results):
+        for reference, result in zip(reference_results, results):
+            self.images += 1
+            num_ref = 0 if reference[0] is None else len(reference[CLS])
+            num = 0 if result[0] is None else len(result[CLS])
+            self.reference += num_ref
+            self.detections += num
+            if num_ref == 0 or num == 0:
+                self.missing += num_ref
+                self.extra += num
+                continue
+            iou = box_iou(reference[BOX2D], result[BOX2D])
+            matched = set()
+            for ref_idx in np.argsort(-iou.max(axis=1)):
+                candidates = [idx for idx in np.argsort(-iou[ref_idx]) if idx not in matched and iou[ref_idx, idx] >= self.match_iou]
+                if len(candidates) == 0:
+                    self.missing += 1
+                    continue
+                idx = candidates[0]
+                matched.add(idx)
+                box_diff = float(np.abs(reference[BOX2D][ref_idx] - result[BOX2D][idx]).max())
+                ref_depth = float(reference[LOCATION][ref_idx, 2])
+                depth_diff = abs(float(result[LOCATION][idx, 2]) - ref_depth) / max(abs(ref_depth), 1e-6)
+                self.max_box_diff = max(self.max_box_diff, box_diff)
+                self.max_depth_diff = max(self.max_depth_diff, depth_diff)
+                self.class_changed += int(reference[CLS][ref_idx].item() != result[CLS][idx].item())
+                self.box_changed += int(box_diff > self.box_tol)
+                self.depth_changed += int(depth_diff > self.depth_tol)
+            self.extra += num - len(matched)
+
+    def summary(self):
+        return {
+            'images': self.images,
+            'reference': self.reference,
+            'detections': self.detections,
+            'missing': self.missing,
+            'extra': self.extra,
+            'class_changed': self.class_changed,
+            'box_changed': self.box_changed,
+            'depth_changed': self.depth_changed,
+            'max_box_diff': self.max_box_diff,
+            'max_depth_diff': self.max_depth_diff,
+            'box_tol': self.box_tol,
+            'depth_tol': self.depth_tol,
+        }
+
+
+def print_parity(summary, precision):
+    print(" {:<12}: {} vs fp32 on {} images, {} fp32 / {} {} detections".format(
+        "parity", precision, summary['images'], summary['reference'], summary['detections'], precision))
+    print(" {:<12}: {} missing, {} extra, {} class, {} box (> {} px), {} depth (> {:.1%}) changed".format(
+        "", summary['missing'], summary['extra'], summary['class_changed'], summary['box_changed'], summary['box_tol'],
+        summary['depth_changed'], summary['depth_tol']))
+    print(" {:<12}: box {:.2f} px, depth {:.2%}".format("max diff", summary['max_box_diff'], summary['max_depth_diff']))
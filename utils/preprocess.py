@@ -0,0 +1,153 @@
+"""
+Crop-resize-normalize preprocessing of the test driver.
+
+The affine transform only depends on (image_size, crop_box, input_size), so it
+is built once per configuration. Each image is then warped with cv2 and
+normalized to a float32 CHW tensor in a single pass.
+
+JPEG images can be decoded at 1/2, 1/4 or 1/8 of their size with the DCT
+scaling of libjpeg (PIL draft mode) when the crop is much larger than the model
+input, only the warp changes: calibration and back-projection still refer to
+the full resolution image.
+"""
+
+import functools
+import threading
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+FOCAL_NORM = 290 # focal length the model is trained with
+JPEG_REDUCTIONS = (8, 4, 2, 1) # scales supported by libjpeg
+
+
+def get_affine_matrix(center, size, output_size):
+    """
+        3x3 affine matrix mapping the box (center, size) of the original image to
+        output_size, same as get_transfrom_matrix of the test scripts.
+    """
+    src_w = size[0]
+    dst_w, dst_h = output_size
+    src_dir = np.array([src_w * -0.5, 0], dtype=np.float32)
+    dst_dir = np.array([dst_w * -0.5, 0], dtype=np.float32)
+
+    src = np.zeros((3, 2), dtype=np.float32)
+    dst = np.zeros((3, 2), dtype=np.float32)
+    src[0, :] = center
+    src[1, :] = center + src_dir
+    dst[0, :] = np.array([dst_w * 0.5, dst_h * 0.5])
+    dst[1, :] = dst[0, :] + dst_dir
+    # third point perpendicular to the first two
+    src[2, :] = src[1, :] + np.array([src[1, 1] - src[0, 1], src[0, 0] - src[1, 0]])
+    dst[2, :] = dst[1, :] + np.array([dst[1, 1] - dst[0, 1], dst[0, 0] - dst[1, 0]])
+
+    matrix = np.eye(3, dtype=np.float32)
+    matrix[:2] = cv2.getAffineTransform(src, dst)
+    return matrix
+
+
+class Preprocessor(object):
+    """
+        Warp the crop_box of an image to input_size and normalize it with mean/std.
+        img_size, input_size: (w, h)
+        crop_box: [lx, ly, rx, ry]
+    """
+
+    def __init__(self, image_size, crop_box, input_size, mean, std):
+        self.image_size = tuple(image_size)
+        self.crop_box = tuple(crop_box)
+        self.input_size = tuple(input_size)
+
+        center = np.array([(crop_box[2] + crop_box[0]) / 2., (crop_box[3] + crop_box[1]) / 2.], dtype=np.float32)
+        size = np.array([crop_box[2] - crop_box[0], crop_box[3] - crop_box[1]], dtype=np.float32)
+        self.center_size = [center, size]
+        self.trans_affine = get_affine_matrix(center, size, self.input_size)
+        self.trans_affine_inv = np.linalg.inv(self.trans_affine)
+
+        self.warp_matrix = self._warp_matrix(1)
+        self._reduced_warp_matrices = {1: self.warp_matrix}
+        # largest reduction for which the crop still has at least input_size pixels
+        max_scale = min(size[0] / self.input_size[0], size[1] / self.input_size[1])
+        self.max_reduction = next(r for r in JPEG_REDUCTIONS if r <= max(max_scale, 1))
+
+        mean = np.asarray(mean, dtype=np.float64).reshape(3, 1, 1)
+        std = np.asarray(std, dtype=np.float64).reshape(3, 1, 1)
+        self.scale = (1.0 / (255.0 * std)).astype(np.float32)
+        self.shift = (mean / std).astype(np.float32)
+        self._local = threading.local()
+
+    def _warp_matrix(self, reduction):
+        # input -> source image decoded at 1/reduction of the original size
+        warp_matrix = self.trans_affine_inv[:2].astype(np.float64) / reduction
+        # PIL's affine transform samples the source at inv(x + 0.5) - 0.5,
+        # fold the half pixel offsets into the inverse map given to cv2
+        warp_matrix[:, 2] += 0.5 * (warp_matrix[:, 0] + warp_matrix[:, 1]) - 0.5
+        return warp_matrix
+
+    def warp(self, img, reduction=1):
+        """
+            Crop and resize to input_size, uint8 HWC. The result is reused by the next call of the same thread.
+            reduction: img was decoded at 1/reduction of image_size
+        """
+        warp_matrix = self._reduced_warp_matrices.get(reduction)
+        if warp_matrix is None:
+            warp_matrix = self._warp_matrix(reduction)
+            self._reduced_warp_matrices[reduction] = warp_matrix
+        input_width, input_height = self.input_size
+        dst = getattr(self._local, "warp_buffer", None)
+        if dst is None:
+            dst = np.empty((input_height, input_width, 3), dtype=np.uint8)
+            self._local.warp_buffer = dst
+        return cv2.warpAffine(np.asarray(img), warp_matrix, (input_width, input_height), dst=dst,
+                              flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_CONSTANT)
+
+    def normalize(self, img, out=None):
+        """ uint8 HWC -> normalized float32 CHW tensor, written into `out` if given. """
+        if out is None:
+            out = torch.empty((3, img.shape[0], img.shape[1]), dtype=torch.float32)
+        out_np = out.numpy()
+        np.multiply(img.transpose(2, 0, 1), self.scale, out=out_np)
+        np.subtract(out_np, self.shift, out=out_np)
+        return out
+
+    def decode(self, impath, reduced=True):
+        """
+            Decode an image as RGB uint8, at the largest JPEG reduction that keeps
+            the crop at model resolution if `reduced`.
+            return: img, original (w, h), reduction
+        """
+        img = Image.open(impath)
+        size = img.size
+        reduction = 1
+        if reduced and self.max_reduction > 1 and img.format == "JPEG":
+            r = self.max_reduction
+            img.draft("RGB", ((size[0] + r - 1) // r, (size[1] + r - 1) // r))
+            reduction = int(round(size[0] / img.size[0]))
+        return np.array(img.convert("RGB")), size, reduction
+
+    def __call__(self, img, calib=None, out=None, reduction=1):
+        """
+            img: PIL image or RGB uint8 array of the original image, or of the
+                 image decoded at 1/reduction of its size
+            calib: updated in place to the model input, as preprocess() of test.py does
+            return: img tensor, calib, scale_z
+        """
+        img = self.normalize(self.warp(img, reduction), out)
+        scale_z = None
+        if calib is not None:
+            calib.matAndUpdate(self.trans_affine)
+            scale_z = calib.normalize_calib(FOCAL_NORM)
+        return img, calib, scale_z
+
+
+@functools.lru_cache(maxsize=None)
+def _get_preprocessor(image_size, crop_box, input_size, mean, std):
+    return Preprocessor(image_size, crop_box, input_size, mean, std)
+
+
+def get_preprocessor(image_size, crop_box, input_size, mean, std):
+    """ Preprocessor shared by every caller of the same configuration. """
+    return _get_preprocessor(tuple(image_size), tuple(crop_box), tuple(input_size),
+                             tuple(float(m) for m in mean), tuple(float(s) for s in std))
@@ -0,0 +1,61 @@
+"""
+torch.profiler capture of the detector (--profile N of test/test.py).
+
+The model and postprocess are run a few times to warm up, then N times under
+the profiler on one real input batch. A Chrome trace (chrome://tracing or
+https://ui.perfetto.dev) and a per-operator table of time, memory and calls
+are written to the output dir. The backbone, FPN, predictor heads and
+postprocess decode steps are annotated with record_function, so they show up
+as named ranges in both.
+"""
+
+import os
+
+import torch
+from torch.autograd.profiler import record_function
+from torch.profiler import ProfilerActivity, profile
+
+
+def profile_detector(model, postproc, imgs, calibs, iters, output_dir, warmup=3, rank=0, row_limit=50):
+    """
+        imgs: input batch on the model device
+        calibs: one Calibration per image of the batch
+        return: paths of the trace and of the operator table, the table
+    """
+    cuda = imgs.is_cuda
+    activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if cuda else [])
+    with torch.no_grad():
+        for _ in range(warmup):
+            output_cls, output_regs = model(imgs)
+            postproc(output_cls.contiguous(), output_regs.contiguous(), calibs)
+        if cuda:
+            torch.cuda.synchronize(imgs.device)
+
+        with profile(activities=activities, record_shapes=True, profile_memory=True) as prof:
+            for _ in range(iters):
+                with record_function("detector"):
+                    output_cls, output_regs = model(imgs)
+                with record_function("postprocess"):
+                    # a no-op unless the model runs channels last
+                    postproc(output_cls.contiguous(), output_regs.contiguous(), calibs)
+            if cuda:
+                torch.cuda.synchronize(imgs.device)
+
+    os.makedirs(output_dir, exist_ok=True)
+    suffix = "" if rank == 0 else ".{}".format(rank)
+    trace_path = os.path.join(output_dir, "profile_trace{}.json".format(suffix))
+    table_path = os.path.join(output_dir, "profile_ops{}.txt".format(suffix))
+    prof.export_chrome_trace(trace_path)
+
+    sort_by = "self_cuda_time_total" if cuda else "self_cpu_time_total"
+    memory_sort_by = "self_cuda_memory_usage" if cuda else "self_cpu_memory_usage"
+    averages = prof.key_averages()
+    table = averages.table(sort_by=sort_by, row_limit=row_limit)
+    with open(table_path, "w") as f:
+        f.write("{} iterations, batch {}, input {}\n\n".format(iters, imgs.shape[0], tuple(imgs.shape[2:])))
+        f.write("[time]\n")
+        f.write(table)
+        f.write("\n\n[memory]\n")
+        f.write(averages.table(sort_by=memory_sort_by, row_limit=row_limit))
+        f.write("\n")
+    return trace_path, table_path, table
@@ -0,0 +1,79 @@
+"""
+Post-training static INT8 quantization of the detector (--quantize of
+test/test.py).
+
+The backbone (Vggx2SmallNet + Vggx2SmallDeconvFPN) and the predictor heads are
+quantized apart with FX graph mode quantization, so that KeypointDetector_v2
+still calls model.backbone then model.heads and the benchmark can still time
+them apart. prepare_fx folds the BatchNorms and fuses Conv -> BN -> ReLU on its
+own, observers are calibrated on real images, convert_fx swaps in the INT8
+kernels. The heatmap sigmoid / clamp and the concatenation of the regression
+heads stay in float: the regression channels (depth, offsets, dimensions,
+orientation) have very different ranges and would share one scale after a
+quantized cat. postprocess is not touched at all.
+
+Quantized kernels run on the CPU only, with the backend (x86 / fbgemm on x86,
+qnnpack on ARM) of torch.backends.quantized.engine.
+"""
+
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+QUANT_BACKENDS = ("x86", "fbgemm", "qnnpack")
+
+
+def set_quant_backend(backend):
+    if backend not in QUANT_BACKENDS:
+        raise ValueError("unknown quantization backend {}, known: {}".format(backend, QUANT_BACKENDS))
+    if backend not in torch.backends.quantized.supported_engines:
+        raise ValueError("quantization backend {} is not supported by this torch build, supported: {}".format(
+            backend, torch.backends.quantized.supported_engines))
+    torch.backends.quantized.engine = backend
+
+
+def get_qconfig_mapping(backend):
+    """ Default static qconfigs of the backend, the outputs of the heads in float. """
+    return (get_default_qconfig_mapping(backend)
+            .set_object_type("sigmoid_", None)
+            .set_object_type("clamp", None)
+            .set_object_type(torch.cat, None))
+
+
+def prepare_detector(model, example_inputs, backend="x86"):
+    """
+        Insert the observers into the backbone and heads of a float
+        KeypointDetector_v2 in eval mode, on the CPU, in place.
+        example_inputs: (1, 3, h, w) float images
+        return: model
+    """
+    if model.training:
+        raise ValueError("the detector can only be quantized in eval mode")
+    set_quant_backend(backend)
+    qconfig_mapping = get_qconfig_mapping(backend)
+    with torch.no_grad():
+        features = model.backbone(example_inputs)
+    model.backbone = prepare_fx(model.backbone, qconfig_mapping, (example_inputs,))
+    model.heads = prepare_fx(model.heads, qconfig_mapping, (features,))
+    return model
+
+
+def calibrate(model, batches):
+    """
+        Run the prepared model on batches of preprocessed images so that the
+        observers record the activation ranges.
+        return: number of images
+    """
+    num_images = 0
+    with torch.no_grad():
+        for images in batches:
+            model(images)
+            num_images += images.shape[0]
+    return num_images
+
+
+def convert_detector(model):
+    """ Calibrated observers to INT8 modules, in place. return: model """
+    model.backbone = convert_fx(model.backbone)
+    model.heads = convert_fx(model.heads)
+    return model.eval()
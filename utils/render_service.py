@@ -0,0 +1,96 @@
+"""
+Background rendering of the test visualizations.
+
+Frames are drawn by a pool of render workers behind a bounded queue, and a
+dedicated thread writes the video streams in frame order. When the workers
+fall behind, frames either wait for a free slot ("block"), or are dropped
+("drop"). Rendering only one frame out of `every` samples long runs.
+"""
+
+import queue
+import threading
+
+from utils.pipeline import Stage, _Failure
+
+RENDER_POLICIES = ("block", "drop")
+
+
+class RenderService(object):
+    def __init__(self, render_func, num_workers=1, queue_size=8, policy="block", every=1, videos=None):
+        """
+            render_func: job -> dict of stream name -> frame, the frames to add to the videos
+            videos: dict of stream name -> cv2.VideoWriter
+        """
+        assert policy in RENDER_POLICIES, "unknown render policy {}".format(policy)
+        self.render_func = render_func
+        self.policy = policy
+        self.every = max(1, every)
+        self.videos = {name: video for name, video in (videos or {}).items() if video is not None}
+        self.rendered = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self._lock = threading.Lock()
+        self._frames = queue.Queue()
+        self._stage = Stage('render', self._render, num_workers, queue_size, output=self._frames).start()
+        self._video_thread = threading.Thread(target=self._write_videos, name="render-video", daemon=True)
+        self._video_thread.start()
+
+    @property
+    def stats(self):
+        return self._stage.stats
+
+    @property
+    def errors(self):
+        """ (frame index, exception) of every frame render_func failed on """
+        return self._stage.errors
+
+    def submit(self, idx, job):
+        """
+            idx: frame index, every index from 0 has to be submitted or skipped
+                 exactly once, in any order
+        """
+        if idx % self.every != 0:
+            with self._lock:
+                self.sampled_out += 1
+            self.skip(idx)
+            return False
+        if not self._stage.put(idx, job, block=self.policy == "block"):
+            with self._lock:
+                self.dropped += 1
+            self.skip(idx)
+            return False
+        return True
+
+    def skip(self, idx):
+        """ No frame for idx, the videos go on with the next one. """
+        self._frames.put((idx, None))
+
+    def close(self):
+        """ Wait for the pending frames and the videos to be written. """
+        self._stage.close(wait=True)
+        self._frames.put((None, None))
+        self._video_thread.join()
+
+    def _render(self, job):
+        # an exception is recorded by the stage, with the frame index
+        frames = self.render_func(job)
+        with self._lock:
+            self.rendered += 1
+        return frames
+
+    def _write_videos(self):
+        # reorder buffer, frames come back in the order the workers finish
+        pending = {}
+        next_idx = 0
+        while True:
+            idx, frames = self._frames.get()
+            if idx is None:
+                break
+            # no frame of a failed render, the videos go on with the next one
+            pending[idx] = None if isinstance(frames, _Failure) else frames
+            while next_idx in pending:
+                frames = pending.pop(next_idx)
+                next_idx += 1
+                for name, frame in (frames or {}).items():
+                    if name in self.videos:
+                        self.videos[name].write(frame)
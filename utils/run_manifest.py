@@ -0,0 +1,121 @@
+"""
+Manifest of a test run, used to resume interrupted runs.
+
+Each process appends to its own json-lines file in the output dir: a header
+with the run config (checkpoint hash, preprocessing parameters, ...) followed
+by one record per finished image. Records are flushed as they are written,
+so a killed run keeps everything it finished. An image is current when a
+manifest with the same config has a record for it, the image did not change
+since, and all its outputs still exist.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import threading
+
+MANIFEST_PREFIX = "run_manifest"
+
+
+def file_sha1(filepath, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _file_stamp(filepath):
+    stat = os.stat(filepath)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class RunManifest(object):
+    def __init__(self, output_dir, run_config, rank=0):
+        """
+            run_config: json serializable dict, records of manifests written
+                        with a different config are ignored
+        """
+        self.output_dir = output_dir
+        self.run_config = json.loads(json.dumps(run_config))
+        self.path = os.path.join(output_dir, "{}.{}.jsonl".format(MANIFEST_PREFIX, rank))
+        self.records = {}
+        self.stale_files = 0
+        self.skipped = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """ Read the records of all matching manifests of output_dir. """
+        for path in sorted(glob.glob(os.path.join(self.output_dir, MANIFEST_PREFIX + ".*.jsonl"))):
+            with open(path) as f:
+                lines = f.readlines()
+            if len(lines) == 0:
+                continue
+            try:
+                header = json.loads(lines[0])
+            except ValueError:
+                self.stale_files += 1
+                continue
+            if header.get("config") != self.run_config:
+                self.stale_files += 1
+                continue
+            for line in lines[1:]:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # last line of a killed run may be truncated
+                    continue
+                self.records[record["image"]] = record
+        return self
+
+    def is_current(self, impath):
+        record = self.records.get(impath)
+        if record is None:
+            return False
+        try:
+            if _file_stamp(impath) != record["stamp"]:
+                return False
+        except OSError:
+            return False
+        return all(os.path.exists(output) for output in record["outputs"])
+
+    def skip_current(self, items, key=None):
+        """ Drop the current items of an iterable as they come, counting them in self.skipped. """
+        for item in items:
+            if self.is_current(item if key is None else key(item)):
+                self.skipped += 1
+            else:
+                yield item
+
+    def open(self):
+        """ Start this process' manifest, keeping its records if the config did not change. """
+        keep = []
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                lines = f.readlines()
+            try:
+                if len(lines) > 0 and json.loads(lines[0]).get("config") == self.run_config:
+                    keep = [line for line in lines[1:] if line.endswith("\n")]
+            except ValueError:
+                pass
+        self._file = open(self.path, "w")
+        self._file.write(json.dumps({"config": self.run_config}) + "\n")
+        self._file.writelines(keep)
+        self._file.flush()
+        return self
+
+    def record(self, impath, outputs):
+        """ Mark an image as finished with the list of files it produced. """
+        record = {"image": impath, "stamp": _file_stamp(impath), "outputs": list(outputs)}
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self.records[impath] = record
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
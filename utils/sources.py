@@ -0,0 +1,136 @@
+"""
+Input sources of the test driver.
+
+Besides the sorted --image_txt list, the sources are generators, so that the
+inference starts on the first frame and memory stays flat however long the
+source is:
+    iter_image_dir   images of a directory tree, scanned lazily
+    iter_video       frames of a video file, decoded one by one
+    tail_image_dir   images of a directory as recorders write them
+Image sources yield paths, video sources yield Frame objects holding the
+decoded image.
+"""
+
+import os
+import re
+import time
+
+import cv2
+import numpy as np
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+class Frame(object):
+    """ A decoded video frame. """
+
+    def __init__(self, name, path, image, calib_name):
+        """
+            name: output file name of the frame, <video>_<index>.jpg
+            path: <video path>#<index>, identifies the frame in logs
+            image: H x W x 3 RGB uint8
+            calib_name: basename of the calibration of the video
+        """
+        self.name = name
+        self.path = path
+        self.image = image
+        self.calib_name = calib_name
+
+    def __repr__(self):
+        return self.path
+
+
+def item_path(item):
+    """ Path of a source item, for logs and the run manifest. """
+    return item.path if isinstance(item, Frame) else item.strip()
+
+
+def natural_keys(text):
+    return [int(c) if c.isdigit() else c for c in re.split(r'(\d+)', text)]
+
+
+def _is_image(name, exts):
+    return name.lower().endswith(exts)
+
+
+def iter_image_dir(root, exts=IMAGE_EXTS, recursive=True):
+    """ Images under root in natural order, one directory listed at a time. """
+    entries = sorted(os.scandir(root), key=lambda entry: natural_keys(entry.name))
+    for entry in entries:
+        if entry.is_dir():
+            if recursive:
+                yield from iter_image_dir(entry.path, exts, recursive)
+        elif _is_image(entry.name, exts):
+            yield entry.path
+
+
+def iter_video(video_path, every=1):
+    """ Every `every`-th frame of a video file. """
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise IOError("can not open video {}".format(video_path))
+    stem = os.path.splitext(os.path.basename(video_path))[0]
+    index = 0
+    try:
+        while True:
+            if index % every != 0:
+                # skipped frames are not decoded
+                if not capture.grab():
+                    break
+            else:
+                ok, image = capture.read()
+                if not ok:
+                    break
+                yield Frame("{}_{:06d}.jpg".format(stem, index), "{}#{}".format(video_path, index),
+                            np.ascontiguousarray(image[..., ::-1]), stem)
+            index += 1
+    finally:
+        capture.release()
+
+
+def tail_image_dir(root, exts=IMAGE_EXTS, poll_interval=1.0, idle_timeout=0):
+    """
+        Images of root (not recursive) in natural order, then the new ones as
+        they are written, until idle_timeout seconds without a new image
+        (0: forever).
+        Recorders are expected to name their frames in increasing order, only
+        names after the last yielded one are picked up, so the state does not
+        grow with the directory. A new file is yielded once its size is the
+        same on two polls in a row, i.e. the recorder is done writing it.
+    """
+    last_key = None
+    sizes = {}
+    first_poll = True
+    idle_since = time.time()
+    while True:
+        pending = []
+        for entry in os.scandir(root):
+            if not entry.is_file() or not _is_image(entry.name, exts):
+                continue
+            key = natural_keys(entry.name)
+            if last_key is not None and key <= last_key:
+                continue
+            pending.append((key, entry.name, entry.stat().st_size))
+        pending.sort()
+
+        if first_poll:
+            # the files already there are complete, but the newest one which
+            # may be in flight
+            num_settled = max(0, len(pending) - 1)
+            first_poll = False
+        else:
+            num_settled = 0
+            for key, name, size in pending:
+                if size == 0 or sizes.get(name) != size:
+                    break
+                num_settled += 1
+        sizes = {name: size for key, name, size in pending[num_settled:]}
+
+        for key, name, size in pending[:num_settled]:
+            last_key = key
+            yield os.path.join(root, name)
+        if num_settled > 0:
+            idle_since = time.time()
+        elif idle_timeout > 0 and time.time() - idle_since > idle_timeout:
+            return
+        time.sleep(poll_interval)
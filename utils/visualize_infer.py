@@ -225,7 +225,7 @@ def show_result_keypoints(img,
                 vedges_flag,
                 vedges,bbox,
                 show=True,
-                out_file=None,POST_PROCESS=False, vis_invis = False):
+                out_file=None,POST_PROCESS=False, vis_invis = False, thickness=4):
     """Visualize the detection results on the image.
 
     Args:
@@ -243,7 +243,6 @@ def show_result_keypoints(img,
         np.ndarray or None: If neither `show` nor `out_file` is specified, the
             visualized image is returned, otherwise None is returned.
     """
-    thickness=4
     bbox_int = bbox.astype(np.int32)
     left_top = (bbox_int[0], bbox_int[1])
     right_bottom = (bbox_int[2], bbox_int[3])